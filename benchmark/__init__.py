@@ -0,0 +1,3 @@
+"""
+benchmark - offline load tests for metatron, with stand-in backends and a fake discord driver. Run with python -m benchmark --help
+"""
@@ -0,0 +1,222 @@
+"""
+Runs scripted load scenarios against metatron with stand-in backends and a fake discord, and reports throughput, latency, event loop lag and peak RSS.
+
+python -m benchmark --scenario all --users 8 --requests 5 --latency 0.05
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from benchmark.backends import StandIns
+from benchmark.fakes import FakeChannel, FakeGuild, FakeInteraction, FakeMessage, FakeUser
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("chat", "stream", "imagegen", "speakgen", "buttons", "sessions", "mixed")
+
+def write_settings(directory, baseurl, args):
+    """settings.cfg from the example with every backend pointed at the stand-ins and all state kept in the temp dir"""
+    overrides = {
+        "token": "benchmark", "wordapi": baseurl, "wordstreamapi": baseurl.replace("http", "ws", 1), "imageapi": baseurl, "speakapi": baseurl,
+        "enableword": "True", "enableimage": "True", "enablespeak": "True", "enableurls": "False", "saveimages": "False", "debug": "False",
+        "historypath": os.path.join(directory, "history.db"), "cachepath": os.path.join(directory, "urlcache.db"), "catalogpath": os.path.join(directory, "catalogs.json"),
+        "mediaspillpath": os.path.join(directory, "mediacache"), "logfile": os.path.join(directory, "bot.log"),
+        "metricsport": "0", "metricsinterval": "0", "settingsreload": "0", "catalogrefresh": "0", "healthinterval": "0", "streamreplies": "False", "streaminterval": "0.2",
+        "defaultmodel": "", "defaultvoice": "",
+    }
+    with open(os.path.join(REPO, "settings-example.cfg"), "r", encoding="utf-8") as example:
+        lines = [line.rstrip("\n") for line in example if line.split("=", 1)[0].strip() not in overrides]
+    lines.extend(f"{key}={value}" for key, value in overrides.items() if value)
+    with open(os.path.join(directory, "settings.cfg"), "w", encoding="utf-8") as settings_file:
+        settings_file.write("\n".join(lines) + "\n")
+
+class LagSampler:
+    """Event loop lag samples for the current scenario"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self.task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(loop.time() - start - self.interval, 0.0))
+
+    def start(self):
+        self.samples = []
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        self.task.cancel()
+        return self.samples
+
+def percentile(samples, fraction):
+    """Nearest rank percentile"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+class Driver:
+    """Plays users against the bot through the fake discord objects"""
+
+    def __init__(self, metatron, standins, baseurl):
+        self.metatron = metatron
+        self.client = metatron.client
+        self.standins = standins
+        self.guild = FakeGuild("benchmark")
+        self.cdn = (baseurl, standins)
+        self.bot = FakeUser("metatron", cdn=self.cdn)
+        self.client._connection.user = self.bot #what discord would fill in on login
+        self.users = []
+        self.channels = []
+
+    def make_users(self, count):
+        """One user and one channel each"""
+        self.users = [FakeUser(f"user{index}", cdn=self.cdn) for index in range(count)]
+        self.channels = [FakeChannel(f"channel{index}", self.guild, self.cdn) for index in range(count)]
+
+    async def chat(self, index, number):
+        """Tags the bot"""
+        message = FakeMessage(self.channels[index], self.users[index], f"{self.bot.mention} tell me about number {number}", mentions=[self.bot])
+        await self.client.on_message(message)
+
+    async def imagegen(self, index, number):
+        """/imagegen"""
+        interaction = FakeInteraction(self.users[index], self.channels[index])
+        await self.metatron.imagegen.callback(interaction, userprompt=f"a stand-in picture number {number}", userbatch=self.batch)
+        return interaction.channel.last
+
+    async def speakgen(self, index, number):
+        """/speakgen"""
+        interaction = FakeInteraction(self.users[index], self.channels[index])
+        await self.metatron.speakgen.callback(interaction, userprompt=" ".join(f"This is sentence {sentence} of request {number}." for sentence in range(self.sentences)))
+        return interaction.channel.last
+
+    async def buttons(self, index, number):
+        """A gen followed by Reroll, Edit, Mail and Delete on it"""
+        posted = await self.imagegen(index, number)
+        if posted is None or posted.view is None:
+            raise RuntimeError("imagegen posted nothing")
+        view = posted.view
+        await view.reroll.callback(FakeInteraction(self.users[index], self.channels[index], posted))
+        await view.dmimage.callback(FakeInteraction(self.users[index], self.channels[index], posted))
+        edit = FakeInteraction(self.users[index], self.channels[index], posted)
+        await view.edit.callback(edit)
+        await edit.modal.on_submit(FakeInteraction(self.users[index], self.channels[index], posted))
+        await view.delete_message.callback(FakeInteraction(self.users[index], self.channels[index], posted))
+
+    async def sessions(self, index, number):
+        """A chat, then its Reroll and Continue pressed at the same time, while every other user does the same. Fails if a reply or history entry belongs to someone else, a turn got lost, or the last posted reply is not the one the history kept."""
+        tag = f"u{index}n{number}"
+        user, channel = self.users[index], self.channels[index]
+        await self.client.on_message(FakeMessage(channel, user, f"{self.bot.mention} {tag} say something", mentions=[self.bot]))
+        posted = channel.last
+        if posted is None or tag not in posted.content or posted.view is None:
+            raise RuntimeError(f"{tag} got someone elses reply: {posted.content if posted else None!r}")
+        reroll, carryon = FakeInteraction(user, channel, posted), FakeInteraction(user, channel, posted)
+        await asyncio.gather(posted.view.reroll.callback(reroll), posted.view.llmcontinue.callback(carryon))
+        history = await self.client.history.get(user.id)
+        expected = min(number + 1, self.metatron.SETTINGS.historyturns)
+        if len(history) != expected or any(not entry[0].startswith(f"u{index}n") for entry in history) or tag not in history[-1][1]:
+            raise RuntimeError(f"{tag} history is wrong: {[entry[0] for entry in history]}")
+        if not reroll.deleted or channel.last is posted or channel.last.view is None or not history[-1][1].endswith(channel.last.content.split(" ", 1)[-1]): #a continue only posts the part it added
+            raise RuntimeError(f"{tag} the last message does not match the history: {channel.last.content!r}")
+
+    async def mixed(self, index, number):
+        """Rotates through chat, image and speech"""
+        await (self.chat, self.imagegen, self.speakgen)[(index + number) % 3](index, number)
+
+async def run_scenario(driver, name, args, sampler):
+    """Every user fires requests one after another, all users at once. Returns the report row."""
+    driver.make_users(args.users)
+    driver.batch = args.batch
+    driver.sentences = args.sentences
+    metatron = driver.metatron
+    metatron.SETTINGS.streamreplies = name == "stream"
+    action = driver.chat if name == "stream" else getattr(driver, name)
+    latencies = []
+    errors = []
+    async def user(index):
+        for number in range(args.requests):
+            start = time.perf_counter()
+            try:
+                await action(index, number)
+            except Exception as error:
+                errors.append(repr(error))
+                continue
+            latencies.append(time.perf_counter() - start)
+    sampler.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(user(index) for index in range(args.users)))
+    elapsed = time.perf_counter() - start
+    lag = sampler.stop()
+    return {
+        "scenario": name, "requests": len(latencies), "errors": len(errors), "seconds": round(elapsed, 3), "rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50": round(percentile(latencies, 0.50), 4), "p95": round(percentile(latencies, 0.95), 4), "p99": round(percentile(latencies, 0.99), 4),
+        "lagmean": round(statistics.fmean(lag), 4) if lag else 0.0, "lagp99": round(percentile(lag, 0.99), 4), "lagmax": round(max(lag, default=0.0), 4),
+        "peakrss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), "firsterror": errors[0] if errors else "",
+    }
+
+def print_table(rows):
+    """Plain text report"""
+    columns = ("scenario", "requests", "errors", "seconds", "rps", "p50", "p95", "p99", "lagmean", "lagp99", "lagmax", "peakrss_mb")
+    widths = {column: max(len(column), *(len(str(row[column])) for row in rows)) for column in columns}
+    print("  ".join(column.rjust(widths[column]) for column in columns))
+    for row in rows:
+        print("  ".join(str(row[column]).rjust(widths[column]) for column in columns))
+        if row["firsterror"]:
+            print(f"    first error: {row['firsterror']}")
+
+async def main(args):
+    """Starts the stand-ins, loads metatron against them and runs the scenarios"""
+    standins = StandIns(latency=args.latency, jitter=args.jitter, reply_chars=args.reply_chars, image_size=args.image_size)
+    baseurl = await standins.start()
+    workdir = tempfile.mkdtemp(prefix="metatron-benchmark-")
+    write_settings(workdir, baseurl, args)
+    os.chdir(workdir) #metatron reads settings.cfg from the working directory on import
+    sys.path.insert(0, REPO)
+    import metatron
+    if not args.verbose:
+        for handler in metatron.LOG_WRITER.handlers[:1]: #console only, the json log file keeps everything
+            handler.setLevel(logging.WARNING)
+    client = metatron.client
+    client.tree.sync = lambda *a, **kw: asyncio.sleep(0) #no discord to sync with
+    await client.setup_hook()
+    driver = Driver(metatron, standins, baseurl)
+    sampler = LagSampler()
+    rows = []
+    for name in (SCENARIOS if args.scenario == "all" else args.scenario.split(",")):
+        rows.append(await run_scenario(driver, name, args, sampler))
+    await client.close()
+    await standins.stop()
+    if args.json:
+        print(json.dumps({"rows": rows, "backend_calls": dict(standins.calls), "workdir": workdir}, indent=1))
+    else:
+        print_table(rows)
+        print(f"backend calls: {dict(standins.calls)}")
+        print(f"logs and state: {workdir}")
+    return 1 if any(row["errors"] for row in rows) else 0 #so a script or CI job running the benchmark sees a broken scenario
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", default="all", help=f"all, or a comma separated list of {', '.join(SCENARIOS)}")
+    parser.add_argument("--users", type=int, default=8, help="users sending requests at the same time")
+    parser.add_argument("--requests", type=int, default=5, help="requests each user sends one after another")
+    parser.add_argument("--latency", type=float, default=0.05, help="base stand-in latency in seconds, txt2img scales it with the batch and model swaps take 4x")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +- seconds added to every stand-in call")
+    parser.add_argument("--reply-chars", type=int, default=400, help="length of stand-in llm replies")
+    parser.add_argument("--image-size", type=int, default=512, help="width and height of stand-in gens")
+    parser.add_argument("--batch", type=int, default=4, help="imagegen batch size")
+    parser.add_argument("--sentences", type=int, default=6, help="sentences per speakgen prompt")
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    parser.add_argument("--verbose", action="store_true", help="keep the bots console logging on")
+    sys.exit(asyncio.run(main(parser.parse_args())))
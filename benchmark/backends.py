@@ -0,0 +1,180 @@
+"""
+Local aiohttp stand-ins for the ooba, A1111 and Bark APIs with configurable latency and payload sizes
+"""
+from collections import Counter
+import asyncio
+import base64
+import io
+import json
+import random
+import wave
+from aiohttp import web
+import numpy as np
+from PIL import Image
+
+class StandIns:
+    """Serves every backend metatron talks to from one local port"""
+
+    def __init__(self, latency=0.05, jitter=0.0, reply_chars=400, stream_chunks=8, image_size=512, seconds_per_char=0.06, sample_rate=24000, models=3, loras=3, voices=3):
+        self.latency = latency
+        self.jitter = jitter
+        self.reply_chars = reply_chars
+        self.stream_chunks = stream_chunks
+        self.seconds_per_char = seconds_per_char
+        self.sample_rate = sample_rate
+        self.models = [f"standin-{index}.safetensors [{index:08x}]" for index in range(models)]
+        self.loras = [f"standin-lora-{index}" for index in range(loras)]
+        self.voices = [f"standin-voice-{index}.npz" for index in range(voices)]
+        self.loaded = self.models[0] if self.models else None
+        self.image = self.make_image(image_size)
+        self.attachments = {} #message id -> bytes, filled by the fake discord channel so the CDN fallback has something to serve
+        self.calls = Counter()
+        self.runner = None
+
+    @staticmethod
+    def make_image(size):
+        """A noisy gradient png, noisy enough that it compresses about as badly as a real gen"""
+        generator = np.random.default_rng(0)
+        gradient = np.linspace(0, 255, size, dtype=np.float32)
+        pixels = np.stack([np.add.outer(gradient, gradient) / 2, np.tile(gradient, (size, 1)), np.tile(gradient[:, None], (1, size))], axis=-1)
+        pixels = np.clip(pixels + generator.normal(0, 24, pixels.shape), 0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format="PNG")
+        return base64.b64encode(buffer.getvalue()).decode()
+
+    async def delay(self, scale=1.0):
+        """Simulated backend work"""
+        await asyncio.sleep(max(self.latency * scale + random.uniform(-self.jitter, self.jitter), 0))
+
+    def reply(self, user_input):
+        """Canned llm reply of reply_chars characters"""
+        base = f"Stand-in reply to: {user_input[:40]} "
+        return (base * (self.reply_chars // len(base) + 1))[:self.reply_chars]
+
+    def wav(self, text):
+        """Silence as long as Bark would take to say the text"""
+        frames = int(len(text) * self.seconds_per_char * self.sample_rate)
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as output:
+            output.setnchannels(1)
+            output.setsampwidth(2)
+            output.setframerate(self.sample_rate)
+            output.writeframes(bytes(frames * 2))
+        return buffer.getvalue()
+
+    async def chat(self, request):
+        """ooba /api/v1/chat"""
+        self.calls["chat"] += 1
+        payload = await request.json()
+        await self.delay()
+        history = payload.get("history", {}).get("internal", [])
+        return web.json_response({"results": [{"history": {"internal": history + [[payload.get("user_input", ""), self.reply(payload.get("user_input", ""))]], "visible": []}}]})
+
+    async def chat_stream(self, request):
+        """ooba /api/v1/chat-stream websocket"""
+        self.calls["chat-stream"] += 1
+        websocket = web.WebSocketResponse()
+        await websocket.prepare(request)
+        payload = json.loads((await websocket.receive()).data)
+        reply = self.reply(payload.get("user_input", ""))
+        for chunk in range(1, self.stream_chunks + 1):
+            await self.delay(1 / self.stream_chunks)
+            await websocket.send_json({"event": "text_stream", "history": {"internal": [[payload.get("user_input", ""), reply[:len(reply) * chunk // self.stream_chunks]]]}})
+        await websocket.send_json({"event": "stream_end"})
+        await websocket.close()
+        return websocket
+
+    async def model(self, request):
+        """ooba loaded model, used as the health check"""
+        self.calls["model"] += 1
+        return web.json_response({"result": "standin"})
+
+    async def sd_models(self, request):
+        """A1111 checkpoint list"""
+        self.calls["sd-models"] += 1
+        return web.json_response([{"title": model} for model in self.models])
+
+    async def sd_loras(self, request):
+        """A1111 lora list"""
+        self.calls["loras"] += 1
+        return web.json_response([{"name": lora} for lora in self.loras])
+
+    async def get_options(self, request):
+        """A1111 options, only the loaded checkpoint matters"""
+        self.calls["get-options"] += 1
+        return web.json_response({"sd_model_checkpoint": self.loaded})
+
+    async def set_options(self, request):
+        """A1111 model swap, slower than a gen like the real thing"""
+        self.calls["set-options"] += 1
+        payload = await request.json()
+        await self.delay(4)
+        self.loaded = payload.get("sd_model_checkpoint", self.loaded)
+        return web.json_response({})
+
+    async def txt2img(self, request):
+        """A1111 txt2img, latency scales with the batch"""
+        self.calls["txt2img"] += 1
+        payload = await request.json()
+        batch = int(payload.get("batch_size", 1))
+        await self.delay(batch)
+        return web.json_response({"images": [self.image] * batch, "parameters": {}, "info": "{}"})
+
+    async def interrupt(self, request):
+        """A1111 interrupt, stops the running gen"""
+        self.calls["interrupt"] += 1
+        return web.json_response({})
+
+    async def interrogate(self, request):
+        """A1111 BLIP interrogate"""
+        self.calls["interrogate"] += 1
+        await request.read()
+        await self.delay()
+        return web.json_response({"caption": "a stand-in picture, digital art"})
+
+    async def txt2wav(self, request):
+        """Bark txt2wav"""
+        self.calls["txt2wav"] += 1
+        text = request.query.get("inputstring", "")
+        await self.delay(max(len(text) / 100, 1))
+        return web.Response(body=self.wav(text), content_type="audio/wav")
+
+    async def list_voices(self, request):
+        """Bark voice list"""
+        self.calls["voices"] += 1
+        return web.json_response({"voices": self.voices})
+
+    async def attachment(self, request):
+        """Discord CDN stand-in for Mail cache misses"""
+        self.calls["cdn"] += 1
+        data = self.attachments.get(int(request.match_info["message_id"]))
+        if data is None:
+            return web.Response(status=404)
+        return web.Response(body=data)
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Starts serving, returns the base url"""
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_post("/api/v1/chat", self.chat)
+        app.router.add_get("/api/v1/chat-stream", self.chat_stream)
+        app.router.add_get("/api/v1/model", self.model)
+        app.router.add_get("/sdapi/v1/sd-models", self.sd_models)
+        app.router.add_get("/sdapi/v1/loras", self.sd_loras)
+        app.router.add_get("/sdapi/v1/options", self.get_options)
+        app.router.add_post("/sdapi/v1/options", self.set_options)
+        app.router.add_post("/sdapi/v1/txt2img", self.txt2img)
+        app.router.add_post("/sdapi/v1/interrupt", self.interrupt)
+        app.router.add_post("/sdapi/v1/interrogate", self.interrogate)
+        app.router.add_get("/txt2wav", self.txt2wav)
+        app.router.add_get("/voices", self.list_voices)
+        app.router.add_get("/attachments/{message_id}/{filename}", self.attachment)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        host, port = self.runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        """Stops serving"""
+        if self.runner is not None:
+            await self.runner.cleanup()
@@ -0,0 +1,160 @@
+"""
+Just enough of discord's users, channels, messages and interactions to drive metatrons handlers without a gateway
+"""
+from itertools import count
+import contextlib
+
+SNOWFLAKES = count(1000000000000000000)
+
+class FakeUser:
+    """A discord user, or the bot itself"""
+
+    def __init__(self, name, user_id=None, cdn=None):
+        self.id = user_id or next(SNOWFLAKES)
+        self.name = name
+        self.mention = f"<@{self.id}>"
+        self.bot = False
+        self.cdn = cdn
+
+    def mentioned_in(self, message):
+        """Same check discord.py does for the bot user"""
+        return self in message.mentions
+
+    async def create_dm(self):
+        """DM channel, same upload cost as any other channel"""
+        return FakeChannel(f"dm-{self.name}", None, self.cdn)
+
+    def __str__(self):
+        return self.name
+
+class FakeGuild:
+    """A discord server"""
+
+    def __init__(self, name):
+        self.id = next(SNOWFLAKES)
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+class FakeAttachment:
+    """An uploaded file, pointing at the stand-in CDN"""
+
+    def __init__(self, url, filename):
+        self.url = url
+        self.filename = filename
+
+class FakeMessage:
+    """A message the bot or a user posted"""
+
+    def __init__(self, channel, author, content="", view=None, attachments=None, mentions=None):
+        self.id = next(SNOWFLAKES)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.view = view
+        self.attachments = attachments or []
+        self.mentions = mentions or []
+        self.edits = 0
+
+    async def edit(self, content=None, view=None, **kwargs):
+        """Counts the edit"""
+        self.edits += 1
+        if content is not None:
+            self.content = content
+        if view is not None:
+            self.view = view
+        return self
+
+    async def delete(self):
+        """Nothing to delete"""
+
+    async def reply(self, content=None, **kwargs):
+        """Replies in the same channel"""
+        return await self.channel.send(content, **kwargs)
+
+class FakeChannel:
+    """A text channel. Uploads are read in full like discord.py does, and kept for the CDN stand-in"""
+
+    def __init__(self, name, guild, cdn=None):
+        self.id = next(SNOWFLAKES)
+        self.name = name
+        self.guild = guild
+        self.cdn = cdn #(base url, backend stand-ins) for attachment urls
+        self.sent = 0
+        self.uploaded = 0
+        self.last = None
+
+    async def send(self, content=None, *, file=None, view=None, ephemeral=False, **kwargs):
+        """Posts a message and returns it"""
+        self.sent += 1
+        attachments = []
+        message = FakeMessage(self, None, content or "", view)
+        if file is not None:
+            data = file.fp.read()
+            self.uploaded += len(data)
+            if self.cdn is not None:
+                baseurl, standins = self.cdn
+                standins.attachments[message.id] = data
+                attachments.append(FakeAttachment(f"{baseurl}/attachments/{message.id}/{file.filename}", file.filename))
+            file.close()
+        message.attachments = attachments
+        self.last = message
+        return message
+
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        """Typing indicator"""
+        yield
+
+    def __str__(self):
+        return self.name
+
+class FakeResponse:
+    """interaction.response"""
+
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.deferred = False
+
+    async def defer(self, **kwargs):
+        """Marks the interaction as acknowledged"""
+        self.deferred = True
+
+    async def send_message(self, content=None, **kwargs):
+        """Initial response"""
+        return await self.interaction.channel.send(content, **kwargs)
+
+    async def send_modal(self, modal):
+        """Keeps the modal so a scenario can submit it"""
+        self.interaction.modal = modal
+
+class FakeFollowup:
+    """interaction.followup, always returns the message like an application webhook does"""
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def send(self, content=None, **kwargs):
+        """Followup message"""
+        return await self.channel.send(content, **kwargs)
+
+class FakeInteraction:
+    """A slash command or button press"""
+
+    def __init__(self, user, channel, message=None):
+        self.id = next(SNOWFLAKES)
+        self.user = user
+        self.channel = channel
+        self.guild = channel.guild
+        self.guild_id = channel.guild.id if channel.guild else None
+        self.message = message
+        self.modal = None
+        self.deleted = False
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(channel)
+
+    async def delete_original_response(self):
+        """Notes that the bot took its original message down"""
+        self.deleted = True
@@ -0,0 +1,78 @@
+"""
+Times prompt moderation: the old one re.sub per blocked term loop against PromptModerator's single compiled pass, at growing blocklist sizes.
+
+python -m benchmark.moderation --terms 10,100,1000,5000 --words 150
+"""
+import argparse
+import os
+import random
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_moderator():
+    """Imports metatron from a temp dir holding a copy of the example settings, it reads settings.cfg from the working directory on import"""
+    workdir = tempfile.mkdtemp(prefix="metatron-moderation-")
+    shutil.copy(os.path.join(REPO, "settings-example.cfg"), os.path.join(workdir, "settings.cfg"))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO)
+    import metatron
+    return metatron.PromptModerator
+
+def loop_moderate(prompt, terms):
+    """moderate_prompt as it was before PromptModerator"""
+    for neg in terms:
+        prompt = re.sub(r'\b' + re.escape(neg) + r'\b', '', prompt)
+    return prompt
+
+def make_words(count, generator):
+    """Distinct made up lowercase words"""
+    words = set()
+    while len(words) < count:
+        words.add("".join(generator.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(generator.randint(4, 10))))
+    return sorted(words)
+
+def make_case(termcount, wordcount, generator):
+    """A blocklist of single words and two word phrases, and a prompt with about a tenth of its words blocked"""
+    vocabulary = make_words(termcount * 2 + wordcount, generator)
+    blocked, allowed = vocabulary[:termcount * 2], vocabulary[termcount * 2:]
+    terms = tuple(f"{blocked[index]} {blocked[index + 1]}" if index % 4 == 0 else blocked[index] for index in range(0, termcount * 2, 2))
+    prompt = ", ".join(generator.choice(terms) if generator.random() < 0.1 else generator.choice(allowed) for _ in range(wordcount))
+    return terms, prompt
+
+def time_call(call, repeats):
+    """Median seconds per call"""
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+def main(args):
+    """Runs every blocklist size and prints one row each"""
+    PromptModerator = load_moderator()
+    generator = random.Random(args.seed)
+    print(f"{'terms':>6}  {'loop_ms':>9}  {'single_ms':>9}  {'speedup':>8}  {'compile_ms':>10}  match")
+    for termcount in (int(count) for count in args.terms.split(",")):
+        terms, prompt = make_case(termcount, args.words, generator)
+        start = time.perf_counter()
+        moderator = PromptModerator(terms, False, True) #the old loops behaviour, case sensitive and whole words
+        compiletime = time.perf_counter() - start
+        looptime = time_call(lambda: loop_moderate(prompt, terms), args.repeats)
+        singletime = time_call(lambda: moderator.moderate(prompt), args.repeats)
+        match = "yes" if moderator.moderate(prompt) == loop_moderate(prompt, terms) else "NO"
+        print(f"{termcount:>6}  {looptime * 1000:>9.3f}  {singletime * 1000:>9.3f}  {looptime / singletime:>7.0f}x  {compiletime * 1000:>10.1f}  {match}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmark.moderation", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--terms", default="10,100,1000,5000", help="comma separated blocklist sizes")
+    parser.add_argument("--words", type=int, default=150, help="words in the prompt")
+    parser.add_argument("--repeats", type=int, default=20, help="timed runs per size, the median is reported")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the made up blocklists and prompts")
+    main(parser.parse_args())
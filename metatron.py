@@ -2,252 +2,2465 @@
 metatron - A discord machine learning bot using rest apis
 """
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict, deque
+import asyncio
+import contextlib
+import contextvars
+import hashlib
+import inspect
+import os
+import sqlite3
+import threading
+import time
 import json
 import io
+import multiprocessing
 import base64
 import math
 import re
+import shutil
+import types
 from datetime import datetime
 import logging
-import requests
+import logging.handlers
+import queue
+import atexit
 from sumy.parsers.html import HtmlParser
 from sumy.nlp.tokenizers import Tokenizer
 from sumy.summarizers.lex_rank import LexRankSummarizer as Summarizer
 from sumy.nlp.stemmers import Stemmer
 from sumy.utils import get_stop_words
-import coloredlogs
 from termcolor import colored
 import discord
 from discord import app_commands
 import aiohttp
+import aiohttp.web
+import numpy as np
 from PIL import Image
 
-class CustomLogFormatter(logging.Formatter):
-    """Strips color escapes from the logfile"""
+BASE64_PATTERN = re.compile(r'^(data:[\w/+.-]+;base64,)?[A-Za-z0-9+/=\s]{256,}$')
+LOG_FIELDS = ("user", "userid", "guild", "channel") #who and where, shown before the event specific fields
+
+def log_event(event, user=None, guild=None, channel=None, message=None, level=logging.INFO, **fields):
+    """Logs one bot event as a structured record. Nothing is formatted or colored here, the log writer thread does that for each handler."""
+    if user is not None:
+        fields["user"], fields["userid"] = getattr(user, "name", str(user)), getattr(user, "id", None)
+    if guild is not None or channel is not None:
+        fields["guild"], fields["channel"] = str(guild), str(channel)
+    logging.log(level, message if message is not None else event, extra={"event": event, "fields": fields})
+
+def elide(value, maxchars):
+    """Copy of a payload for logging with base64 blobs replaced by their size and other long strings cut to maxchars"""
+    if isinstance(value, dict):
+        return {key: elide(item, maxchars) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [elide(item, maxchars) for item in value]
+    if isinstance(value, str) and len(value) > maxchars:
+        if BASE64_PATTERN.match(value[:4096]):
+            return f'<base64 {len(value)} chars>'
+        return f'{value[:maxchars]}...<{len(value) - maxchars} more chars>'
+    return value
+
+def log_payload(event, payload):
+    """Debug dump of an api payload or response with base64 images elided and long strings cut"""
+    log_event(event, level=logging.DEBUG, payload=elide(payload, current_settings().logfieldchars))
+
+class ConsoleFormatter(logging.Formatter):
+    """Colored one line per record for the terminal, the only place colors are applied"""
     def format(self, record):
-        message = super().format(record)
-        return re.sub(r'\x1b\[[0-9;]*[mK]', '', message)
-
-coloredlogs.install(level='DEBUG', fmt='%(message)s', logger=logging.getLogger())
-logging.getLogger('PIL').setLevel(logging.WARNING) #Suppress noisy PIL logging
-logging.getLogger('urllib3').setLevel(logging.WARNING) #same but for urllib
-logging.getLogger('discord').setLevel(logging.INFO)
-file_handler = logging.FileHandler('bot.log')
-file_handler.setLevel(logging.DEBUG)
-file_formatter = CustomLogFormatter('%(message)s')
-file_handler.setFormatter(file_formatter)
-logging.getLogger().addHandler(file_handler)
-
-SETTINGS = {}
-concurrent_requests_per_user = {}
-global_interaction_history = {}
-
-with open("settings.cfg", "r", encoding="utf-8") as settings_file: #this builds the SETTINGS variable.
-    for line in settings_file:
-        if "=" in line:
-            key, value = (line.split("=", 1)[0].strip(), line.split("=", 1)[1].strip())
-            if key in SETTINGS:             # Check if the key already exists in SETTINGS
-                if isinstance(SETTINGS[key], list):
-                    SETTINGS[key].append(value)
-                else: SETTINGS[key] = [SETTINGS[key], value]
-            else: SETTINGS[key] = [value]  # Always store values as a list
-    if SETTINGS["debug"][0] == 'True':
-        logging.debug(f'DEBUG SETTINGS BEGIN: {colored(json.dumps(SETTINGS, indent=1), "light_blue")}')
+        timestamp = colored(datetime.fromtimestamp(record.created).strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")
+        event = getattr(record, "event", None)
+        messagecolor = "red" if record.levelno >= logging.WARNING else "light_blue"
+        if event is None:
+            line = f'{timestamp} | {colored(record.levelname.lower().ljust(8), "cyan")} | {colored(record.name, "yellow")} | {colored(record.getMessage(), messagecolor)}'
+        else:
+            fields = record.fields
+            parts = [timestamp, colored(event.ljust(8), "cyan")]
+            if "user" in fields:
+                parts.append(f'{colored(fields["user"], "yellow")}:{colored(fields["userid"], "light_yellow")}')
+            if "guild" in fields:
+                parts.append(f'{colored(fields["guild"], "red")}:{colored(fields["channel"], "light_red")}')
+            if record.msg != event:
+                parts.append(colored(record.getMessage(), messagecolor))
+            for key, value in fields.items():
+                if key not in LOG_FIELDS:
+                    shown = json.dumps(value) if isinstance(value, (dict, list)) else value
+                    parts.append(f'{"P" if key == "prompt" else key}={colored(shown, "red" if key == "error" else "light_magenta")}')
+            line = " | ".join(parts)
+        if record.exc_info:
+            line = f'{line}\n{self.formatException(record.exc_info)}'
+        return line
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line for the log file"""
+    def format(self, record):
+        entry = {"time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"), "level": record.levelname, "logger": record.name}
+        event = getattr(record, "event", None)
+        if event is not None:
+            entry["event"] = event
+            entry.update(record.fields)
+        if event is None or record.msg != event:
+            entry["message"] = record.getMessage()
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class DeferredFlushMixin:
+    """Leaves flushing to the log writer, which flushes once per batch instead of once per record"""
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        """Flushes whatever the batch wrote"""
+        with self.lock:
+            if self.stream is not None and hasattr(self.stream, "flush"):
+                self.stream.flush()
+
+class ConsoleHandler(DeferredFlushMixin, logging.StreamHandler):
+    """Terminal handler flushed per batch"""
+
+class LogFileHandler(DeferredFlushMixin, logging.handlers.RotatingFileHandler):
+    """Size capped, rotating log file flushed per batch"""
+
+class LogWriter(threading.Thread):
+    """Drains the log queue on its own thread, formatting and writing records in batches so the event loop never waits on the terminal or the disk"""
+
+    def __init__(self, logqueue, handlers, batchsize=512):
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = logqueue
+        self.handlers = handlers
+        self.batchsize = batchsize
+
+    def run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batchsize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            running = self.write(batch)
+
+    def write(self, batch):
+        """Hands a batch to the handlers, returns False if it held the stop marker"""
+        running = True
+        for record in batch:
+            if record is None: #stop marker
+                running = False
+                continue
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+        for handler in self.handlers:
+            handler.flush_batch()
+        return running
+
+    def stop(self):
+        """Writes out everything queued so far and closes the handlers"""
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+        elif self.ident is None and multiprocessing.parent_process() is None: #never started, the bot died before setup_hook, so write the queue out here. Pool workers leave theirs unwritten
+            batch = []
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.write(batch)
+        for handler in self.handlers:
+            handler.close()
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Puts records on the log queue as they are, the writer thread formats them"""
+    def prepare(self, record):
+        return record
+
+def setup_logging(settings):
+    """Routes every log record through one queue to the console and the rotating JSON lines log file.
+    The writer is started by the bot, records logged before that wait in the queue and are written at exit if it never starts. Image pool workers import this file and must never write to the log."""
+    console_handler = ConsoleHandler()
+    console_handler.setFormatter(ConsoleFormatter())
+    file_handler = LogFileHandler(settings.logfile, maxBytes=settings.logmaxbytes, backupCount=settings.logbackups, encoding="utf-8", delay=True)
+    file_handler.setFormatter(JsonFormatter())
+    logqueue = queue.SimpleQueue()
+    writer = LogWriter(logqueue, [console_handler, file_handler])
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG)
+    root.addHandler(DeferredQueueHandler(logqueue))
+    logging.getLogger('PIL').setLevel(logging.WARNING) #Suppress noisy PIL logging
+    logging.getLogger('urllib3').setLevel(logging.WARNING) #same but for urllib
+    logging.getLogger('discord').setLevel(logging.INFO)
+    atexit.register(writer.stop)
+    return writer
+
+class Settings:
+    """Typed view of settings.cfg. Everything is parsed and validated once, and the lookups the commands need are built up front."""
+
+    def __init__(self, raw):
+        self.raw = raw #key -> list of raw string values, kept for debug output
+        self.token = self.required("token")
+        self.wordapis = self.urls("wordapi", "http://localhost:5000") #every backend can list several nodes, requests are spread across them
+        self.wordstreamapis = self.urls("wordstreamapi", "ws://localhost:5005")
+        if len(self.wordstreamapis) not in (1, len(self.wordapis)):
+            raise ValueError('settings.cfg: wordstreamapi needs one address, or one for every wordapi node in the same order')
+        self.imageapis = self.urls("imageapi", "http://localhost:7860")
+        self.speakapis = self.urls("speakapi", "http://localhost:8086")
+        self.debug = self.flag("debug")
+        self.enableimage = self.flag("enableimage")
+        self.enableword = self.flag("enableword")
+        self.enableurls = self.flag("enableurls")
+        self.enablespeak = self.flag("enablespeak")
+        self.multimodal = self.flag("multimodal")
+        self.saveimages = self.flag("saveimages")
+        self.savepath = self.text("savepath", "outputs")
+        self.maxwidth = self.integer("maxwidth", 512)
+        self.maxheight = self.integer("maxheight", 512)
+        self.maxbatch = self.integer("maxbatch", 4)
+        self.maxrequests = self.integer("maxrequests", 1)
+        self.imagesettings = self.payload("imagesettings")
+        self.wordsettings = types.MappingProxyType(self.payload("wordsettings")) #read only template, every chat request builds its own payload on top
+        self.bannedusers = frozenset(self.snowflake(user, "bannedusers") for user in self.text("bannedusers").split(",") if user.strip())
+        self.ignorefields = frozenset(field.strip() for field in self.text("ignorefields").split(",") if field.strip())
+        self.negativeterms = tuple(neg.strip() for neg in self.imagesettings.get("negative_prompt", "").split(",") if neg.strip()) #the global negatives double as the prompt blocklist
+        self.modelprompts = {} #checkpoint -> (mandatory prompt, mandatory negative)
+        for line in raw.get("models", []):
+            model, modelprompt, modelnegative = self.fields(line, "models", 3)
+            self.modelprompts[model] = (modelprompt, modelnegative)
+        self.defaultmodels = {} #channel or guild id -> (checkpoint, prompt, negative)
+        for line in raw.get("defaultmodel", []):
+            checkid, defaultmodelname, defaultmodelprompt, defaultmodelneg = self.fields(line, "defaultmodel", 4)
+            self.defaultmodels[self.snowflake(checkid, "defaultmodel")] = (defaultmodelname, defaultmodelprompt, defaultmodelneg)
+        self.defaultvoices = {} #channel or guild id -> voicefile
+        for line in raw.get("defaultvoice", []):
+            checkid, defaultvoicename = self.fields(line, "defaultvoice", 2)
+            self.defaultvoices[self.snowflake(checkid, "defaultvoice")] = defaultvoicename
+        self.connecttimeout = self.number("connecttimeout", 10)
+        self.readtimeout = self.number("readtimeout", 600)
+        self.connectionlimit = self.integer("connectionlimit", 100)
+        self.connectionsperhost = self.integer("connectionsperhost", 10)
+        self.keepalive = self.number("keepalive", 60)
+        self.extracttimeout = self.number("extracttimeout", 30)
+        self.extractworkers = self.integer("extractworkers", 4)
+        self.imagemaxbytes = self.integer("imagemaxbytes", 20971520)
+        self.imagemaxdim = self.integer("imagemaxdim", 1024)
+        self.imagejpegquality = self.integer("imagejpegquality", 85)
+        self.cachesize = self.integer("cachesize", 256)
+        self.cachettl = self.number("cachettl", 3600)
+        self.cachepath = self.text("cachepath")
+        self.imageformat = self.choice("imageformat", "PNG", ("PNG", "WEBP", "JPEG"))
+        self.imagequality = self.integer("imagequality", 90)
+        self.imagecompression = self.integer("imagecompression", 6)
+        self.maxupload = self.integer("maxupload", 10485760)
+        self.imageworkers = self.integer("imageworkers", 2)
+        self.queuestarvation = self.number("queuestarvation", 60)
+        self.historypath = self.text("historypath", "history.db")
+        self.historyusers = self.integer("historyusers", 1000)
+        self.historyflush = self.number("historyflush", 5)
+        self.historyturns = self.integer("historyturns", 10)
+        self.contexttokens = self.integer("contexttokens", 2048)
+        self.streamreplies = self.flag("streamreplies")
+        self.streaminterval = self.number("streaminterval", 1.5)
+        self.wordconcurrency = self.integer("wordconcurrency", 2)
+        self.imageconcurrency = self.integer("imageconcurrency", 4)
+        self.speakconcurrency = self.integer("speakconcurrency", 2)
+        self.settingsreload = self.number("settingsreload", 5)
+        self.logfile = self.text("logfile", "bot.log")
+        self.catalogpath = self.text("catalogpath", "catalogs.json")
+        self.catalogtimeout = self.number("catalogtimeout", 10)
+        self.catalogrefresh = self.number("catalogrefresh", 600)
+        self.logmaxbytes = self.integer("logmaxbytes", 10485760)
+        self.logbackups = self.integer("logbackups", 5)
+        self.logfieldchars = self.integer("logfieldchars", 1000)
+        self.speakchunkchars = self.integer("speakchunkchars", 200)
+        self.speakparallel = self.integer("speakparallel", 2)
+        self.speakformat = self.choice("speakformat", "WAV", ("WAV", "OGG", "MP3", "FLAC"))
+        self.metricsport = self.integer("metricsport", 0)
+        self.metricshost = self.text("metricshost", "127.0.0.1")
+        self.metricsinterval = self.number("metricsinterval", 0)
+        self.mediacachebytes = self.integer("mediacachebytes", 268435456)
+        self.mediaspillpath = self.text("mediaspillpath")
+        self.mediaspillbytes = self.integer("mediaspillbytes", 1073741824)
+        self.archivepath = self.text("archivepath", "archive.db")
+        self.archiveworkers = self.integer("archiveworkers", 2)
+        self.archivesync = self.number("archivesync", 5)
+        self.archivereuse = self.flag("archivereuse", True)
+        self.moderationignorecase = self.flag("moderationignorecase")
+        self.moderationwholeword = self.flag("moderationwholeword", True)
+        self.healthinterval = self.number("healthinterval", 15)
+        self.healthtimeout = self.number("healthtimeout", 5)
+        self.nodefailures = self.integer("nodefailures", 2)
+        self.breakerfailures = self.integer("breakerfailures", 5)
+        self.breakercooldown = self.number("breakercooldown", 30)
+        self.worddeadline = self.number("worddeadline", 300)
+        self.imagedeadline = self.number("imagedeadline", 600)
+        self.speakdeadline = self.number("speakdeadline", 300)
+
+    def text(self, key, default=""):
+        """First value for key"""
+        return self.raw.get(key, [default])[0]
+
+    def urls(self, key, default):
+        """Comma separated list of node addresses, at least one"""
+        return tuple(url.strip().rstrip("/") for url in self.text(key, default).split(",") if url.strip()) or (default,)
+
+    def required(self, key):
+        """First value for a key that has to be set"""
+        if not self.text(key):
+            raise ValueError(f'settings.cfg: {key} is required')
+        return self.text(key)
+
+    def flag(self, key, default=False):
+        """True only if the value is exactly True, like it always has been"""
+        return self.text(key, str(default)) == "True"
+
+    def integer(self, key, default):
+        """Whole number value"""
+        try:
+            return int(self.text(key, str(default)))
+        except ValueError:
+            raise ValueError(f'settings.cfg: {key} must be a whole number, got {self.text(key)!r}') from None
+
+    def number(self, key, default):
+        """Decimal value"""
+        try:
+            return float(self.text(key, str(default)))
+        except ValueError:
+            raise ValueError(f'settings.cfg: {key} must be a number, got {self.text(key)!r}') from None
+
+    def choice(self, key, default, choices):
+        """Value that has to be one of choices"""
+        value = self.text(key, default).upper()
+        if value not in choices:
+            raise ValueError(f'settings.cfg: {key} must be one of {", ".join(choices)}, got {value!r}')
+        return value
+
+    def payload(self, key):
+        """JSON api payload"""
+        try:
+            return json.loads(self.text(key, "{}"))
+        except json.JSONDecodeError as error:
+            raise ValueError(f'settings.cfg: {key} is not valid JSON, {error}') from None
+
+    @staticmethod
+    def snowflake(value, key):
+        """Discord id"""
+        try:
+            return int(value.strip())
+        except ValueError:
+            raise ValueError(f'settings.cfg: {key} has {value!r} where a discord id should be') from None
+
+    @staticmethod
+    def fields(line, key, count):
+        """Splits a | separated line into exactly count fields"""
+        fields = line.strip().split("|", count - 1)
+        if len(fields) != count:
+            raise ValueError(f'settings.cfg: {key}={line} needs {count} fields separated by |')
+        return fields
+
+def load_settings(path):
+    """Reads settings.cfg into a Settings object"""
+    raw = {}
+    with open(path, "r", encoding="utf-8") as settings_file:
+        for line in settings_file:
+            if "=" in line:
+                key, value = (line.split("=", 1)[0].strip(), line.split("=", 1)[1].strip())
+                raw.setdefault(key, []).append(value)  # Always store values as a list
+    return Settings(raw)
+
+SETTINGS = load_settings("settings.cfg")
+REQUEST_SETTINGS = contextvars.ContextVar("settings", default=None) #the settings the current request started with, None outside a request
+
+def snapshot_settings():
+    """Pins the live settings for the rest of the current request and returns them, so a reload mid request cant mix old and new values.
+    Taken by SettingsSnapshot for slash commands, buttons and modals and by on_message for chats, everything the request awaits and the image jobs it queues read them back with current_settings."""
+    REQUEST_SETTINGS.set(SETTINGS)
+    return SETTINGS
+
+def current_settings():
+    """The settings of the request being handled, or the live ones outside a request"""
+    return REQUEST_SETTINGS.get() or SETTINGS
+
+class SettingsSnapshot:
+    """Mixin for the command tree, the button views and the modals that snapshots the settings for every interaction they dispatch"""
+    async def interaction_check(self, interaction):
+        snapshot_settings() #discord.py awaits this in the same task right before the callback, so the callback and everything it awaits see the snapshot
+        return True
+
+LOG_WRITER = setup_logging(SETTINGS)
+if SETTINGS.debug:
+    log_event("settings", level=logging.DEBUG, settings={**SETTINGS.raw, "token": ["<hidden>"]})
+
+IMAGE_EXTENSIONS = {"PNG": "png", "WEBP": "webp", "JPEG": "jpg"}
+
+def encode_image(image, imageformat, quality, compression):
+    """Encodes a PIL image as PNG, lossless WebP or JPEG"""
+    buffer = io.BytesIO()
+    if imageformat == "WEBP":
+        image.save(buffer, format='WEBP', lossless=True, quality=quality, method=min(compression, 6))
+    elif imageformat == "JPEG":
+        image.save(buffer, format='JPEG', quality=quality, optimize=True)
+    else: image.save(buffer, format='PNG', compress_level=min(compression, 9))
+    return buffer.getvalue()
+
+def composite_images(images, imageformat, quality, compression, maxupload):
+    """Decodes the base64 images, tiles them into a grid and encodes it, runs in the image process pool.
+    Returns the upload encode and the full quality encode, stepping the upload down until it fits under maxupload."""
+    arrays = []
+    for encoded in images:
+        image = Image.open(io.BytesIO(base64.b64decode(encoded.split(",", 1)[0]))).convert('RGB')
+        if arrays and image.size != (arrays[0].shape[1], arrays[0].shape[0]):
+            image = image.resize((arrays[0].shape[1], arrays[0].shape[0])) #odd sized extras get fit to the first image
+        arrays.append(np.asarray(image))
+    height, width = arrays[0].shape[:2]
+    num_images_per_row = math.ceil(math.sqrt(len(arrays)))
+    num_rows = math.ceil(len(arrays) / num_images_per_row)
+    stack = np.zeros((num_rows * num_images_per_row, height, width, 3), dtype=np.uint8) #empty grid slots stay black
+    stack[:len(arrays)] = arrays
+    grid = stack.reshape(num_rows, num_images_per_row, height, width, 3).swapaxes(1, 2).reshape(num_rows * height, num_images_per_row * width, 3)
+    composite_image = Image.fromarray(grid)
+    full_bytes = encode_image(composite_image, imageformat, quality, compression)
+    upload_bytes, upload_format = fit_upload(composite_image, full_bytes, imageformat, quality, compression, maxupload)
+    return upload_bytes, upload_format, full_bytes, imageformat
+
+def fit_upload(image, full_bytes, imageformat, quality, compression, maxupload):
+    """Returns (bytes, format) to upload, the full quality encode if it fits under maxupload, otherwise a jpeg stepped down until it does"""
+    if len(full_bytes) <= maxupload:
+        return full_bytes, imageformat
+    upload_image = image
+    while True: #step jpeg quality down, then halve the resolution, until it fits
+        for stepquality in range(min(quality, 90), 19, -10):
+            upload_bytes = encode_image(upload_image, "JPEG", stepquality, compression)
+            if len(upload_bytes) <= maxupload:
+                return upload_bytes, "JPEG"
+        if min(upload_image.size) <= 64:
+            return upload_bytes, "JPEG"
+        upload_image = upload_image.resize((upload_image.width // 2, upload_image.height // 2))
+
+def refit_upload(data, imageformat, quality, compression, maxupload):
+    """Decodes an archived encode and fits it under maxupload, runs in the image process pool"""
+    return fit_upload(Image.open(io.BytesIO(data)).convert('RGB'), data, imageformat, quality, compression, maxupload)
+
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?])\s+')
+SPEECH_FORMATS = {"OGG": ("ogg", ["-c:a", "libopus", "-f", "ogg"]), "MP3": ("mp3", ["-c:a", "libmp3lame", "-f", "mp3"]), "FLAC": ("flac", ["-f", "flac"])} #format -> (extension, ffmpeg output args)
+
+def split_speech(text, maxchars):
+    """Splits text into chunks of whole sentences up to maxchars long, a sentence thats too long on its own is split between words"""
+    chunks = []
+    current = ""
+    for sentence in SENTENCE_PATTERN.split(text.strip()):
+        pieces = [sentence]
+        if len(sentence) > maxchars:
+            pieces, piece = [], ""
+            for word in sentence.split():
+                if piece and len(piece) + len(word) + 1 > maxchars:
+                    pieces.append(piece)
+                    piece = word
+                else: piece = f"{piece} {word}" if piece else word
+            pieces.append(piece)
+        for piece in pieces:
+            if current and len(current) + len(piece) + 1 > maxchars:
+                chunks.append(current)
+                current = piece
+            else: current = f"{current} {piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def wav_data(wav):
+    """Returns the fmt chunk and a memoryview over the sample data of a RIFF wav without copying it"""
+    view = memoryview(wav)
+    if bytes(view[0:4]) != b'RIFF' or bytes(view[8:12]) != b'WAVE':
+        raise ValueError("speak api did not return a wav")
+    offset = 12
+    fmt = None
+    while offset + 8 <= len(view):
+        chunkid = bytes(view[offset:offset + 4])
+        size = int.from_bytes(view[offset + 4:offset + 8], "little")
+        if chunkid == b'fmt ':
+            fmt = bytes(view[offset + 8:offset + 8 + size])
+        elif chunkid == b'data':
+            if fmt is None:
+                raise ValueError("wav data came before its format")
+            return fmt, view[offset + 8:offset + 8 + size]
+        offset += 8 + size + (size & 1) #chunks are padded to an even length
+    raise ValueError("wav has no data")
+
+def join_wavs(wavs):
+    """Joins wavs of the same format in order without copying their sample data. Returns the joined wav as pieces to write out one after another, a new header followed by views into each chunk."""
+    parts = [wav_data(wav) for wav in wavs]
+    fmt = parts[0][0]
+    if any(part[0] != fmt for part in parts):
+        raise ValueError("speech chunks came back in different formats")
+    datasize = sum(len(data) for _, data in parts)
+    header = b'RIFF' + (4 + 8 + len(fmt) + 8 + datasize + (datasize & 1)).to_bytes(4, "little") + b'WAVE'
+    header += b'fmt ' + len(fmt).to_bytes(4, "little") + bytes(fmt) + b'data' + datasize.to_bytes(4, "little")
+    pieces = [header, *(data for _, data in parts)]
+    if datasize & 1:
+        pieces.append(b'\0')
+    return pieces
+
+def wav_file(pieces):
+    """The pieces of a wav as one file object ready to upload"""
+    return io.BytesIO(pieces[0] if len(pieces) == 1 else b''.join(pieces)) #a lone chunk is uploaded as it came, BytesIO shares its bytes
+
+async def encode_speech(pieces, speakformat):
+    """Re-encodes the wav pieces with ffmpeg for a smaller upload, returns (file object, extension). The pieces are written straight to ffmpegs stdin, the wav is only joined if ffmpeg is missing or fails."""
+    if speakformat not in SPEECH_FORMATS:
+        return wav_file(pieces), "wav"
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        log_event("speakgen", message=f"speakformat={speakformat} needs ffmpeg on the PATH, sending wav", level=logging.WARNING)
+        return wav_file(pieces), "wav"
+    extension, outputargs = SPEECH_FORMATS[speakformat]
+    process = await asyncio.create_subprocess_exec(ffmpeg, "-loglevel", "error", "-i", "pipe:0", *outputargs, "pipe:1", stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    async def feed():
+        try:
+            for piece in pieces:
+                process.stdin.write(piece)
+                await process.stdin.drain()
+            process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError): #ffmpeg quit early, its exit code and stderr say why
+            pass
+    try:
+        encoded, error, _ = await asyncio.gather(process.stdout.read(), process.stderr.read(), feed())
+        await process.wait()
+    except BaseException: #cancelled or past the deadline, dont leave ffmpeg running
+        if process.returncode is None:
+            process.kill()
+        raise
+    if process.returncode != 0 or not encoded:
+        reason = error.decode(errors="replace").strip()
+        log_event("speakgen", message="ffmpeg failed, sending wav", level=logging.WARNING, error=reason)
+        return wav_file(pieces), "wav"
+    return io.BytesIO(encoded), extension
+
+def build_session():
+    """Builds a long lived keep-alive session with a pooled connector and the configured timeouts"""
+    connector = aiohttp.TCPConnector(limit=SETTINGS.connectionlimit, limit_per_host=SETTINGS.connectionsperhost, keepalive_timeout=SETTINGS.keepalive)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=SETTINGS.connecttimeout, sock_read=SETTINGS.readtimeout)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+class PromptModerator:
+    """Strips blocklisted terms from prompts in a single pass. The terms are folded into a trie and compiled into one regex once, so the cost no longer grows with the size of the blocklist."""
+
+    def __init__(self, terms, ignorecase=False, wholeword=True):
+        self.key = (terms, ignorecase, wholeword) #rebuild only when this changes
+        self.terms = len(set(terms))
+        self.pattern = None
+        if terms:
+            body = self.trie_pattern(self.build_trie(term.lower() if ignorecase else term for term in terms))
+            self.pattern = re.compile(rf'\b(?:{body})\b' if wholeword else body, re.IGNORECASE if ignorecase else 0)
+
+    @staticmethod
+    def build_trie(terms):
+        """Nested dict trie of the terms, an empty string key marks the end of a term"""
+        trie = {}
+        for term in terms:
+            node = trie
+            for char in term:
+                node = node.setdefault(char, {})
+            node[""] = {}
+        return trie
+
+    def trie_pattern(self, node):
+        """Turns a trie node into a regex with shared prefixes, longer terms are tried before their prefixes"""
+        branches = [re.escape(char) + self.trie_pattern(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else f'(?:{"|".join(branches)})'
+        return f'(?:{body})?' if "" in node else body
+
+    def moderate(self, prompt):
+        """Removes every blocklisted term from the prompt"""
+        if self.pattern is None:
+            return prompt
+        return self.pattern.sub('', prompt)
+
+class TTLCache:
+    """Bounded LRU cache with per entry expiry, shared in-flight computations and an optional sqlite tier that survives restarts"""
+
+    def __init__(self, maxsize, ttl, diskpath=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict() #key -> (expiry, value), oldest first
+        self.inflight = {}
+        self.stats = {"hits": 0, "diskhits": 0, "misses": 0, "shared": 0, "evictions": 0, "expired": 0}
+        self.disk = None
+        self.disklock = threading.Lock()
+        if diskpath:
+            self.disk = sqlite3.connect(diskpath, check_same_thread=False)
+            self.disk.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expiry REAL, value TEXT)")
+            self.disk.execute("DELETE FROM cache WHERE expiry < ?", (time.time(),)) #drop anything that expired while we were down
+            self.disk.commit()
+
+    def get(self, key):
+        """Returns a fresh in-memory value or None"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del self.entries[key]
+            self.stats["expired"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[1]
+
+    def put(self, key, value, expiry=None):
+        """Stores a value in memory, evicting the least recently used entries past maxsize"""
+        self.entries[key] = (expiry or time.time() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    async def get_or_compute(self, key, factory):
+        """Returns the cached value for key, otherwise awaits factory() once no matter how many callers ask at the same time"""
+        value = self.get(key)
+        if value is not None:
+            return value
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self.load(key, factory))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else: self.stats["shared"] += 1
+        return await asyncio.shield(task) #a caller hitting its deadline does not cancel the shared computation
+
+    async def load(self, key, factory):
+        """Checks the disk tier, then computes and stores the value. None results are not cached."""
+        if self.disk is not None:
+            row = await asyncio.to_thread(self.disk_get, key)
+            if row is not None:
+                self.stats["diskhits"] += 1
+                self.put(key, row[1], row[0])
+                return row[1]
+        self.stats["misses"] += 1
+        value = await factory()
+        if value is not None:
+            self.put(key, value)
+            if self.disk is not None:
+                await asyncio.to_thread(self.disk_put, key, self.entries[key][0], value)
+        return value
+
+    def disk_get(self, key):
+        """Reads a fresh entry from the sqlite tier"""
+        with self.disklock:
+            return self.disk.execute("SELECT expiry, value FROM cache WHERE key = ? AND expiry >= ?", (key, time.time())).fetchone()
+
+    def disk_put(self, key, expiry, value):
+        """Writes an entry to the sqlite tier"""
+        with self.disklock:
+            self.disk.execute("INSERT OR REPLACE INTO cache (key, expiry, value) VALUES (?, ?, ?)", (key, expiry, value))
+            self.disk.commit()
+
+    def report(self):
+        """Returns the counters along with the current size for sizing the cache"""
+        return {**self.stats, "size": len(self.entries), "maxsize": self.maxsize, "inflight": len(self.inflight)}
+
+    def close(self):
+        """Closes the sqlite tier"""
+        if self.disk is not None:
+            with self.disklock:
+                self.disk.close()
+
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+INLINE_IMAGE_PATTERN = re.compile(r'\s*<img src="data:[^"]*">')
+
+def estimate_tokens(text):
+    """Cheap token estimate, words and punctuation or a quarter of the characters for things like base64 that dont split into words"""
+    return max(len(TOKEN_PATTERN.findall(text)), len(text) // 4)
+
+def count_turn_tokens(entry):
+    """Returns the token estimate for a question/answer pair with and without its inline images"""
+    full = sum(estimate_tokens(part) for part in entry)
+    stripped = sum(estimate_tokens(INLINE_IMAGE_PATTERN.sub('', part)) for part in entry)
+    return full, stripped
+
+class HistoryStore:
+    """Per user chat history persisted to sqlite. Histories are loaded the first time a user talks to the bot,
+    only the most recently active users stay in memory and changes are written back in batches."""
+
+    def __init__(self, path, maxusers, flushinterval, maxturns=10):
+        self.maxusers = maxusers
+        self.flushinterval = flushinterval
+        self.maxturns = maxturns
+        self.histories = OrderedDict() #user_id -> list of [user, llm] pairs, least recently used first
+        self.tokens = {} #user_id -> list of (tokens, tokens without inline images) per pair, counted once when the pair is added
+        self.dirty = set()
+        self.evicted = {} #dirty histories pushed out of memory before they were written
+        self.disk = sqlite3.connect(path, check_same_thread=False)
+        self.disk.execute("CREATE TABLE IF NOT EXISTS history (user_id INTEGER PRIMARY KEY, turns TEXT)")
+        self.disk.commit()
+        self.disklock = threading.Lock()
+        self.worker = None
+
+    def start(self):
+        """Starts the periodic write-back task"""
+        self.worker = asyncio.create_task(self.run())
+
+    async def get(self, user_id):
+        """Returns the users history list, loading it from disk if it is not in memory"""
+        history = self.histories.get(user_id)
+        if history is None:
+            if user_id in self.evicted:
+                history = json.loads(self.evicted.pop(user_id))
+                self.dirty.add(user_id) #still unwritten, so it stays dirty
+            else:
+                row = await asyncio.to_thread(self.disk_get, user_id)
+                history = json.loads(row[0]) if row else []
+            if user_id in self.histories: #someone else loaded it while we were waiting on disk
+                history = self.histories[user_id]
+            else: self.tokens[user_id] = [count_turn_tokens(entry) for entry in history]
+            self.histories[user_id] = history
+        self.histories.move_to_end(user_id)
+        while len(self.histories) > self.maxusers:
+            old_id, old_history = self.histories.popitem(last=False)
+            del self.tokens[old_id]
+            if old_id in self.dirty:
+                self.evicted[old_id] = json.dumps(old_history)
+                self.dirty.discard(old_id)
+        return history
+
+    def touch(self, user_id):
+        """Marks a history as changed so the next flush writes it"""
+        self.dirty.add(user_id)
+
+    async def append(self, user_id, entry):
+        """Adds a question/answer pair, dropping the oldest once maxturns is reached"""
+        history = await self.get(user_id)
+        history.append(entry)
+        self.tokens[user_id].append(count_turn_tokens(entry))
+        if len(history) > self.maxturns:
+            history.pop(0)
+            self.tokens[user_id].pop(0)
+        self.touch(user_id)
+
+    async def pop(self, user_id, index=-1):
+        """Removes a pair from the history if there is one"""
+        history = await self.get(user_id)
+        if len(history) >= abs(index):
+            history.pop(index)
+            self.tokens[user_id].pop(index)
+            self.touch(user_id)
+
+    async def wipe(self, user_id):
+        """Clears a users history"""
+        history = await self.get(user_id)
+        history.clear()
+        self.tokens[user_id].clear()
+        self.touch(user_id)
+
+    async def window(self, user_id, budget):
+        """Returns a copy of the newest part of the history that fits in budget tokens using the cached counts.
+        Inline images are stripped from older pairs first, then the oldest pairs are dropped."""
+        history = await self.get(user_id)
+        counts = self.tokens[user_id]
+        window = [list(entry) for entry in history]
+        kept = [full for full, _ in counts]
+        total = sum(kept)
+        for index in range(len(window) - 1): #the newest pair keeps its images
+            if total <= budget:
+                break
+            full, stripped = counts[index]
+            if stripped < full:
+                window[index] = [INLINE_IMAGE_PATTERN.sub('', part) for part in window[index]]
+                kept[index] = stripped
+                total -= full - stripped
+        start = 0
+        while start < len(window) and total > budget:
+            total -= kept[start]
+            start += 1
+        return window[start:]
+
+    async def flush(self):
+        """Writes every changed history in a single transaction"""
+        rows = [(user_id, json.dumps(self.histories[user_id])) for user_id in self.dirty if user_id in self.histories]
+        rows.extend(self.evicted.items())
+        self.dirty.clear()
+        self.evicted = {}
+        if rows:
+            await asyncio.to_thread(self.disk_put, rows)
+
+    async def run(self):
+        """Flushes on an interval"""
+        while True:
+            await asyncio.sleep(self.flushinterval)
+            await self.flush()
+
+    def disk_get(self, user_id):
+        """Reads one history row"""
+        with self.disklock:
+            return self.disk.execute("SELECT turns FROM history WHERE user_id = ?", (user_id,)).fetchone()
+
+    def disk_put(self, rows):
+        """Writes a batch of history rows"""
+        with self.disklock:
+            self.disk.executemany("INSERT OR REPLACE INTO history (user_id, turns) VALUES (?, ?)", rows)
+            self.disk.commit()
+
+    def report(self):
+        """Returns how many histories are held and waiting to be written"""
+        return {"users": len(self.histories), "maxusers": self.maxusers, "dirty": len(self.dirty), "evicted": len(self.evicted)}
+
+    async def close(self):
+        """Stops the write-back task and writes anything outstanding"""
+        if self.worker is not None:
+            self.worker.cancel()
+        await self.flush()
+        with self.disklock:
+            self.disk.close()
+
+class ChatRequest:
+    """One chat generation: a read only payload template and what this request puts on top of it.
+    Nothing here is changed after it is made, so a request can be kept by the buttons and sent again while others are in flight."""
+    __slots__ = ("template", "user_input", "continuing")
+
+    def __init__(self, template, user_input, continuing=False):
+        self.template = template
+        self.user_input = user_input
+        self.continuing = continuing
+
+    def again(self, continuing=False):
+        """The same request for a reroll or continue"""
+        return ChatRequest(self.template, self.user_input, continuing)
+
+    def payload(self, history):
+        """Builds the api payload, a shallow copy of the template with this requests fields and the history window on top"""
+        payload = dict(self.template)
+        payload["user_input"] = self.user_input
+        payload["history"] = {"internal": history, "visible": history}
+        if self.continuing:
+            payload["_continue"] = True
+        return payload
+
+class ChatSession:
+    """A users chat lock. Everything that reads and then changes a users history holds it, so one user's chats, rerolls and continues take turns while different users run at once."""
+    __slots__ = ("user_id", "lock", "holders")
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.lock = asyncio.Lock()
+        self.holders = 0 #holding or waiting, a session is only dropped at 0 so nobody ends up with a second lock for the same user
+
+    @contextlib.asynccontextmanager
+    async def hold(self):
+        """Holds the users lock for the duration of the block"""
+        self.holders += 1
+        try:
+            async with self.lock:
+                yield self
+        finally:
+            self.holders -= 1
+
+class ChatSessions:
+    """Chat sessions by user, the least recently used idle ones are dropped past maxusers"""
+
+    def __init__(self, maxusers):
+        self.maxusers = maxusers
+        self.sessions = OrderedDict()
+
+    def get(self, user_id):
+        """Returns the users session, making one if needed"""
+        session = self.sessions.get(user_id)
+        if session is None:
+            session = self.sessions[user_id] = ChatSession(user_id)
+        self.sessions.move_to_end(user_id)
+        excess = len(self.sessions) - self.maxusers
+        for old_id in list(self.sessions)[:max(excess, 0)]:
+            if not self.sessions[old_id].holders:
+                del self.sessions[old_id]
+        return session
+
+    def hold(self, user_id):
+        """Holds a users lock for the duration of an async with block"""
+        return self.get(user_id).hold()
+
+    def report(self):
+        """Returns how many sessions are held and how many are busy"""
+        return {"sessions": len(self.sessions), "busy": sum(1 for session in self.sessions.values() if session.holders)}
+
+class MediaCache:
+    """Byte budgeted LRU of the media the bot posted, keyed by message id, so Mail can skip the round trip to the discord CDN.
+    Entries pushed out of memory spill to a directory on disk until that budget runs out too."""
+
+    def __init__(self, maxbytes, spillpath=None, spillbytes=0):
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict() #message id -> (data, filename, payload), oldest first
+        self.size = 0
+        self.spillpath = spillpath
+        self.spillbytes = spillbytes if spillpath else 0
+        self.spilled = OrderedDict() #message id -> (filename, payload, size) for entries on disk
+        self.spillsize = 0
+        self.writing = {} #entries on their way to disk, still served from memory
+        self.stats = {"hits": 0, "diskhits": 0, "misses": 0, "spills": 0, "evictions": 0}
+        if self.spillbytes:
+            os.makedirs(spillpath, exist_ok=True)
+            for leftover in os.listdir(spillpath): #the index doesnt survive a restart so neither do the files
+                os.remove(os.path.join(spillpath, leftover))
+
+    def spillfile(self, key):
+        """Path of a spilled entry"""
+        return os.path.join(self.spillpath, f'{key}.bin')
+
+    async def put(self, key, data, filename, payload=None):
+        """Stores freshly posted media, spilling the least recently used entries once memory is over budget"""
+        if len(data) > self.maxbytes: #too big to ever sit in memory, dont push everything else out for it
+            await self.spill(key, (data, filename, payload))
+            return
+        self.entries[key] = (data, filename, payload)
+        self.size += len(data)
+        spill = []
+        while self.size > self.maxbytes and self.entries:
+            oldkey, entry = self.entries.popitem(last=False)
+            self.size -= len(entry[0])
+            spill.append((oldkey, entry))
+        for oldkey, entry in spill:
+            await self.spill(oldkey, entry)
+
+    async def spill(self, key, entry):
+        """Moves an entry to disk, or drops it when there is no disk budget"""
+        data, filename, payload = entry
+        if len(data) > self.spillbytes:
+            self.stats["evictions"] += 1
+            return
+        self.writing[key] = entry
+        try:
+            await asyncio.to_thread(self.write_file, self.spillfile(key), data)
+        except OSError as error:
+            self.stats["evictions"] += 1
+            log_event("media", message="spill failed", level=logging.WARNING, error=str(error))
+            return
+        finally:
+            self.writing.pop(key, None)
+        self.spilled[key] = (filename, payload, len(data))
+        self.spillsize += len(data)
+        self.stats["spills"] += 1
+        while self.spillsize > self.spillbytes and self.spilled:
+            await self.discard(next(iter(self.spilled)))
+            self.stats["evictions"] += 1
+
+    async def get(self, key):
+        """Returns (data, filename, payload) for a message or None"""
+        entry = self.entries.get(key) or self.writing.get(key)
+        if entry is not None:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry
+        if key in self.spilled:
+            filename, payload, _ = self.spilled[key]
+            try:
+                data = await asyncio.to_thread(self.read_file, self.spillfile(key))
+            except OSError:
+                data = None
+            if data is not None and key in self.spilled: #it may have been discarded while we were reading
+                self.spilled.move_to_end(key)
+                self.stats["diskhits"] += 1
+                return data, filename, payload
+        self.stats["misses"] += 1
+        return None
+
+    async def discard(self, key):
+        """Forgets a message, used when it is deleted"""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+        spilled = self.spilled.pop(key, None)
+        if spilled is not None:
+            self.spillsize -= spilled[2]
+            with contextlib.suppress(OSError):
+                await asyncio.to_thread(os.remove, self.spillfile(key))
+
+    @staticmethod
+    def write_file(path, data):
+        """Writes a spill file"""
+        with open(path, "wb") as spill_file:
+            spill_file.write(data)
+
+    @staticmethod
+    def read_file(path):
+        """Reads a spill file"""
+        with open(path, "rb") as spill_file:
+            return spill_file.read()
+
+    def report(self):
+        """Returns the counters along with memory and disk use"""
+        return {**self.stats, "entries": len(self.entries), "bytes": self.size, "maxbytes": self.maxbytes, "spilled": len(self.spilled), "spillbytes": self.spillsize, "maxspillbytes": self.spillbytes}
+
+class GenerationArchive:
+    """Saved gens under content addressed file names, with a sqlite index of the payload, seed, model, user and time of each and full text search over the prompts.
+    Files are written by a thread pool and fsynced together with their index rows in batches."""
+
+    def __init__(self, savepath, indexpath, workers, syncinterval):
+        self.savepath = savepath
+        self.syncinterval = syncinterval
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.writes = set() #store tasks still running
+        self.pending = [] #(index row, path or None if the file already existed) waiting for the next sync
+        self.recent = {} #payloadkey -> path for pending rows, so lookups find them before they are indexed
+        self.stats = {"saved": 0, "deduped": 0, "reused": 0, "bytes": 0}
+        self.disk = sqlite3.connect(indexpath, check_same_thread=False)
+        self.disk.execute("CREATE TABLE IF NOT EXISTS generations (id INTEGER PRIMARY KEY, digest TEXT, path TEXT, payloadkey TEXT, prompt TEXT, negative TEXT, seed INTEGER, model TEXT, user_id INTEGER, created REAL, payload TEXT)")
+        self.disk.execute("CREATE INDEX IF NOT EXISTS generations_payloadkey ON generations (payloadkey)")
+        try:
+            self.disk.execute("CREATE VIRTUAL TABLE IF NOT EXISTS prompts USING fts5(prompt, negative, content='generations', content_rowid='id')")
+            self.fulltext = True
+        except sqlite3.OperationalError: #sqlite built without fts5, search falls back to LIKE
+            self.fulltext = False
+        self.disk.commit()
+        self.disklock = threading.Lock()
+        self.worker = None
+
+    @staticmethod
+    def payload_key(payload, model):
+        """Hash of everything that decides what A1111 draws"""
+        return hashlib.sha256(json.dumps({"payload": payload, "model": model}, sort_keys=True).encode()).hexdigest()
+
+    def start(self):
+        """Starts the periodic sync task"""
+        self.worker = asyncio.create_task(self.run())
+
+    def save(self, data, extension, payload, seed, model, user_id):
+        """Archives a gen in the background. seed is the one A1111 actually used, so a random seed gen can later be re-served by asking for that seed."""
+        task = asyncio.create_task(self.store(data, extension, dict(payload), seed, model, user_id))
+        self.writes.add(task)
+        task.add_done_callback(self.writes.discard)
+
+    async def store(self, data, extension, payload, seed, model, user_id):
+        """Writes the file in the pool and queues its index row for the next sync"""
+        digest, path, written = await asyncio.get_running_loop().run_in_executor(self.pool, self.write_file, self.savepath, data, extension)
+        payloadkey = self.payload_key({**payload, "seed": seed} if seed is not None else payload, model)
+        row = (digest, path, payloadkey, payload.get("prompt", ""), payload.get("negative_prompt", ""), seed, model, user_id, time.time(), json.dumps(payload))
+        self.pending.append((row, path if written else None))
+        self.recent[payloadkey] = path
+        self.stats["saved" if written else "deduped"] += 1
+        self.stats["bytes"] += len(data) if written else 0
+
+    @staticmethod
+    def write_file(savepath, data, extension):
+        """Writes data under its sha256 unless that file already exists, runs in the archive pool. Returns (digest, path, whether it was written)."""
+        digest = hashlib.sha256(data).hexdigest()
+        directory = os.path.join(savepath, digest[:2]) #fan out so no directory gets huge
+        path = os.path.join(directory, f'{digest}.{extension}')
+        if os.path.exists(path):
+            return digest, path, False
+        os.makedirs(directory, exist_ok=True)
+        temppath = f'{path}.{threading.get_ident()}.tmp'
+        with open(temppath, "wb") as output_file:
+            output_file.write(data)
+        os.replace(temppath, path)
+        return digest, path, True
+
+    @staticmethod
+    def read_file(path):
+        """Reads an archived file"""
+        with open(path, "rb") as archive_file:
+            return archive_file.read()
+
+    async def lookup(self, payload, model):
+        """Returns (bytes, path) of an earlier gen of exactly this payload on this model, or None"""
+        payloadkey = self.payload_key(payload, model)
+        path = self.recent.get(payloadkey)
+        if path is None:
+            row = await asyncio.to_thread(self.disk_get, payloadkey)
+            path = row[0] if row else None
+        if path is None:
+            return None
+        try:
+            data = await asyncio.get_running_loop().run_in_executor(self.pool, self.read_file, path)
+        except OSError: #the file was cleaned out of the savepath by hand
+            return None
+        self.stats["reused"] += 1
+        return data, path
+
+    async def search(self, query, user_id, limit):
+        """Returns (prompt, seed, model, created) for a users gens whose prompt matches query, best matches first"""
+        await self.flush()
+        return await asyncio.to_thread(self.disk_search, query, user_id, limit)
+
+    async def flush(self):
+        """fsyncs everything written since the last sync and indexes it in one transaction"""
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        await asyncio.to_thread(self.disk_put, batch)
+        for row, _ in batch:
+            if self.recent.get(row[2]) == row[1]:
+                del self.recent[row[2]]
+
+    async def run(self):
+        """Syncs on an interval"""
+        while True:
+            await asyncio.sleep(self.syncinterval)
+            await self.flush()
+
+    def disk_get(self, payloadkey):
+        """Newest archived file for a payload key"""
+        with self.disklock:
+            return self.disk.execute("SELECT path FROM generations WHERE payloadkey = ? ORDER BY id DESC LIMIT 1", (payloadkey,)).fetchone()
+
+    def disk_search(self, query, user_id, limit):
+        """Full text search over a users prompts"""
+        with self.disklock:
+            if self.fulltext:
+                terms = " ".join('"' + term.replace('"', '""') + '"' for term in query.split()) #every word is matched literally so user input cant be fts syntax
+                if not terms:
+                    return []
+                return self.disk.execute("SELECT generations.prompt, seed, model, created FROM prompts JOIN generations ON generations.id = prompts.rowid WHERE prompts MATCH ? AND user_id = ? ORDER BY rank LIMIT ?", (terms, user_id, limit)).fetchall()
+            return self.disk.execute("SELECT prompt, seed, model, created FROM generations WHERE prompt LIKE ? AND user_id = ? ORDER BY id DESC LIMIT ?", (f'%{query}%', user_id, limit)).fetchall()
+
+    def disk_put(self, batch):
+        """fsyncs a batch of files and their directories, then writes their index rows"""
+        paths = [path for _, path in batch if path is not None]
+        for path in paths + sorted({os.path.dirname(path) for path in paths}): #directories too so the renames survive a crash
+            try:
+                descriptor = os.open(path, os.O_RDONLY)
+            except OSError: #windows cannot open directories
+                continue
+            try:
+                os.fsync(descriptor)
+            except OSError:
+                pass
+            finally:
+                os.close(descriptor)
+        with self.disklock:
+            for row, _ in batch:
+                cursor = self.disk.execute("INSERT INTO generations (digest, path, payloadkey, prompt, negative, seed, model, user_id, created, payload) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+                if self.fulltext:
+                    self.disk.execute("INSERT INTO prompts (rowid, prompt, negative) VALUES (?, ?, ?)", (cursor.lastrowid, row[3], row[4]))
+            self.disk.commit()
+
+    def report(self):
+        """Returns the counters along with writes still in flight"""
+        return {**self.stats, "writing": len(self.writes), "pending": len(self.pending)}
+
+    async def close(self):
+        """Finishes the running writes, syncs them and closes the index"""
+        if self.worker is not None:
+            self.worker.cancel()
+        if self.writes:
+            await asyncio.gather(*self.writes, return_exceptions=True)
+        await self.flush()
+        self.pool.shutdown(wait=True)
+        with self.disklock:
+            self.disk.close()
+
+class AdmissionGate:
+    """Caps how many requests a backend runs at once, globally and per user.
+    Users that have to wait are served round robin so one heavy user cannot starve everyone else."""
+
+    def __init__(self, name, limit, peruser):
+        self.name = name
+        self.limit = limit
+        self.peruser = peruser
+        self.active = 0
+        self.active_users = {}
+        self.waiting = OrderedDict() #user_id -> deque of waiter futures, in round robin order
+        self.stats = {"admitted": 0, "queued": 0, "waittotal": 0.0, "waitmax": 0.0}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id, notify=None):
+        """Holds a slot for the duration of the block, yields whether the caller had to wait. notify(position) is awaited if the caller gets queued."""
+        waited = await self.acquire(user_id, notify)
+        try:
+            yield waited
+        finally:
+            self.release(user_id)
+
+    async def acquire(self, user_id, notify):
+        """Queues behind anyone already waiting and returns once admitted"""
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(user_id, deque()).append(future)
+        self.dispatch()
+        if future.done():
+            return False
+        queued = time.monotonic()
+        self.stats["queued"] += 1
+        if current_settings().debug:
+            log_event("queue", level=logging.DEBUG, **self.report())
+        try:
+            if notify is not None:
+                await notify(self.position(user_id, future))
+            await future
+        except BaseException: #cancelled, or the queue notice failed to send, either way we are not taking the slot
+            if future.done() and not future.cancelled(): #we were admitted in the meantime, give the slot back
+                self.release(user_id)
+            else: future.cancel()
+            raise
+        waittime = time.monotonic() - queued
+        self.stats["waittotal"] += waittime
+        self.stats["waitmax"] = max(self.stats["waitmax"], waittime)
+        return True
+
+    def release(self, user_id):
+        """Frees a slot and admits whoever is next"""
+        self.active -= 1
+        self.active_users[user_id] -= 1
+        if not self.active_users[user_id]:
+            del self.active_users[user_id]
+        self.dispatch()
+
+    def dispatch(self):
+        """Admits waiters round robin across users until the global cap is reached or everyone left is at their own cap"""
+        progressed = True
+        while progressed and self.active < self.limit:
+            progressed = False
+            for user_id in list(self.waiting):
+                if self.active >= self.limit:
+                    break
+                if self.active_users.get(user_id, 0) >= self.peruser:
+                    continue
+                queue = self.waiting[user_id]
+                future = queue.popleft()
+                if queue:
+                    self.waiting.move_to_end(user_id) #this user had their turn, go to the back
+                else: del self.waiting[user_id]
+                progressed = True
+                if future.done(): #cancelled while waiting
+                    continue
+                self.active += 1
+                self.active_users[user_id] = self.active_users.get(user_id, 0) + 1
+                self.stats["admitted"] += 1
+                future.set_result(None)
+
+    def position(self, user_id, future):
+        """Rough place in line, each user ahead in the rotation gets one turn per round"""
+        queue = self.waiting.get(user_id, ())
+        index = queue.index(future) if future in queue else 0
+        ahead = sum(min(len(other), index + 1) for other_id, other in self.waiting.items() if other_id != user_id)
+        return ahead + index + 1
+
+    def report(self):
+        """Returns queue depth, active count and wait times for monitoring"""
+        depth = sum(len(queue) for queue in self.waiting.values())
+        meanwait = self.stats["waittotal"] / self.stats["queued"] if self.stats["queued"] else 0.0
+        return {"backend": self.name, "active": self.active, "limit": self.limit, "depth": depth, "waitingusers": len(self.waiting), "meanwait": round(meanwait, 3), **self.stats}
+
+def queue_notifier(send, name, **kwargs):
+    """Returns a notify callback that tells a user where they are in a backend queue"""
+    async def notify(position):
+        await send(f"You are number {position} in the {name} queue.", **kwargs)
+    return notify
+
+DEADLINE = contextvars.ContextVar("deadline", default=None) #event loop time the current request has to be done by, None for no deadline
+
+async def with_deadline(seconds, coroutine):
+    """Awaits coroutine, cancelling it and raising asyncio.TimeoutError once seconds have passed. 0 means no deadline.
+    Backend calls made inside see the deadline through DEADLINE."""
+    if seconds <= 0:
+        return await coroutine
+    token = DEADLINE.set(asyncio.get_running_loop().time() + seconds)
+    try:
+        return await asyncio.wait_for(coroutine, seconds)
+    finally:
+        DEADLINE.reset(token)
+
+def deadline_passed():
+    """True if the current request has a deadline and it is up"""
+    deadline = DEADLINE.get()
+    return deadline is not None and asyncio.get_running_loop().time() >= deadline
+
+class BackendDown(Exception):
+    """Raised instead of sending a request to a backend whose circuit breaker is open"""
+
+    def __init__(self, backend, retryafter):
+        super().__init__(f'The {backend} backend is down, try again in {math.ceil(retryafter)} seconds.')
+        self.backend = backend
+        self.retryafter = retryafter
+
+class BackendError(Exception):
+    """Raised when a backend answers with an error status, or None for a reply that broke off. Those and 5xx replies count against the node and the circuit breaker like a dropped connection"""
+
+    def __init__(self, backend, status, reason=None):
+        super().__init__(f'The {backend} backend returned an error ({reason or status}), try again later.')
+        self.backend = backend
+        self.status = status
+
+class MissingCheckpoint(Exception):
+    """Raised for image jobs asking for a checkpoint no healthy A1111 node has"""
+
+    def __init__(self, checkpoint):
+        super().__init__(f'No image backend has the model {checkpoint}, pick another one.')
+        self.checkpoint = checkpoint
+
+class BackendNode:
+    """One server behind a backend pool"""
+
+    def __init__(self, url, streamurl=None):
+        self.url = url
+        self.streamurl = streamurl #ooba only, the chat-stream websocket of the same server
+        self.healthy = True
+        self.failures = 0 #failed requests in a row
+        self.outstanding = 0
+        self.checkpoint = None #A1111 only, the loaded checkpoint as of the last health check or swap
+        self.models = None #A1111 only, checkpoints this node has, None until its catalog loads
+        self.stats = {"requests": 0, "errors": 0, "ejections": 0}
+
+    def report(self):
+        """Returns health, load and counters for monitoring"""
+        return {"healthy": int(self.healthy), "outstanding": self.outstanding, **self.stats}
+
+class BackendPool:
+    """The nodes behind one backend. Requests go to the healthy node with the fewest requests in flight.
+    Nodes whose requests keep failing are taken out until a health check passes again. If the whole backend keeps failing its circuit breaker opens,
+    and requests fail fast with BackendDown for breakercooldown seconds. After that requests are let through again and the first failure reopens it."""
+
+    def __init__(self, name, nodes, healthpath, maxfailures, breakerfailures, breakercooldown):
+        self.name = name
+        self.nodes = nodes
+        self.healthpath = healthpath
+        self.maxfailures = maxfailures
+        self.breakerfailures = breakerfailures
+        self.breakercooldown = breakercooldown
+        self.streak = 0 #failed requests in a row across every node
+        self.openuntil = 0.0 #monotonic time the breaker is open until, 0 while closed
+        self.trips = 0
+
+    def admit(self):
+        """Raises BackendDown while the breaker is open"""
+        remaining = self.openuntil - time.monotonic()
+        if remaining > 0:
+            raise BackendDown(self.name, remaining)
+
+    def trip(self, error):
+        """Opens the breaker"""
+        if self.openuntil <= time.monotonic():
+            self.trips += 1
+            log_event("backend", message=f"the {self.name} backend is down, failing requests fast for {self.breakercooldown:g} seconds", level=logging.WARNING, error=repr(error))
+        self.openuntil = time.monotonic() + self.breakercooldown
+
+    def close(self):
+        """Closes the breaker after a success"""
+        self.streak = 0
+        if self.openuntil:
+            self.openuntil = 0.0
+            log_event("backend", message=f"the {self.name} backend is back up")
+
+    def healthy_nodes(self):
+        """Nodes taking requests. If every node looks down they are all tried anyway, the health checks may just be behind."""
+        return [node for node in self.nodes if node.healthy] or self.nodes
+
+    def pick(self, checkpoint=None):
+        """Least outstanding healthy node, preferring nodes that already have checkpoint loaded. Ties go to the node used least so far."""
+        candidates = self.healthy_nodes()
+        if checkpoint:
+            candidates = [node for node in candidates if node.checkpoint == checkpoint] or candidates
+        return min(candidates, key=lambda node: (node.outstanding, node.stats["requests"]))
+
+    @contextlib.asynccontextmanager
+    async def lease(self, node=None, checkpoint=None):
+        """Counts a request against a node for the duration of the block, picking one if node is None. Raises BackendDown while the breaker is open.
+        Connection errors, timeouts, 5xx replies and still running when the request deadline hits count towards taking the node out and opening the breaker."""
+        self.admit()
+        node = node or self.pick(checkpoint)
+        node.outstanding += 1
+        node.stats["requests"] += 1
+        try:
+            yield node
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+            self.failed(node, error)
+            raise
+        except BackendError as error:
+            if error.status is None or error.status >= 500: #a proxy with nothing behind it or a backend with no model loaded, the node is up but useless
+                self.failed(node, error)
+            raise
+        except asyncio.CancelledError:
+            if deadline_passed(): #the node was still working when time ran out, a hung backend looks exactly like this
+                self.failed(node, asyncio.TimeoutError("request deadline passed"))
+            raise
+        else:
+            node.failures = 0
+            self.close()
+        finally:
+            node.outstanding -= 1
+
+    def failed(self, node, error):
+        """Records a failed request, the node is taken out once maxfailures happen in a row and the breaker opens once breakerfailures happen in a row across the pool"""
+        node.failures += 1
+        node.stats["errors"] += 1
+        if node.healthy and node.failures >= self.maxfailures:
+            node.healthy = False
+            node.stats["ejections"] += 1
+            log_event("backend", message=f"{node.url} taken out of the {self.name} pool", level=logging.WARNING, error=repr(error))
+        self.streak += 1
+        if self.streak >= self.breakerfailures:
+            self.trip(error)
+
+    async def check(self, session, timeout, inspect=None):
+        """Probes every node at once. Failing nodes are taken out and recovered ones let back in. inspect(node, data) is called with each healthy reply.
+        The breaker opens if every node fails and closes if any passes."""
+        async def probe(node):
+            try:
+                async with session.get(f'{node.url}{self.healthpath}', timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    if response.status != 200:
+                        raise ValueError(f'health check returned {response.status}')
+                    data = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+                node.failures = max(node.failures, self.maxfailures - 1)
+                self.failed(node, error)
+                return error
+            if inspect is not None:
+                inspect(node, data)
+            if not node.healthy:
+                log_event("backend", message=f"{node.url} back in the {self.name} pool")
+            node.healthy = True
+            node.failures = 0
+            return None
+        errors = await asyncio.gather(*(probe(node) for node in self.nodes))
+        if all(errors):
+            self.trip(errors[0])
+        else: self.close()
+
+    def report(self):
+        """Returns node counts and load for monitoring"""
+        return {"nodes": len(self.nodes), "healthy": sum(node.healthy for node in self.nodes), "outstanding": sum(node.outstanding for node in self.nodes), "breakeropen": int(self.openuntil > time.monotonic()), "breakertrips": self.trips}
+
+class ImageJob:
+    """A queued image generation"""
+
+    def __init__(self, payload, user_id, checkpoint, modelprompts):
+        self.payload = payload
+        self.user_id = user_id
+        self.checkpoint = checkpoint #None means whatever is loaded
+        self.modelprompts = modelprompts
+        self.model = None
+        self.queued = time.monotonic()
+        self.deadline = DEADLINE.get() #the runner gets the submitters deadline so a node still working past it counts as failing
+        self.settings = current_settings() #and its settings snapshot, so a reload while the job is queued does not change its model prompts
+        self.future = asyncio.get_running_loop().create_future()
+
+class ImageScheduler:
+    """Runs image jobs one at a time on each A1111 node. A node runs every job for the checkpoint it has loaded before swapping, and leaves jobs for checkpoints another node has loaded to that node.
+    A job that has waited longer than the starvation bound goes next regardless of its checkpoint. Jobs for a checkpoint no healthy node has fail with MissingCheckpoint."""
+
+    def __init__(self, runner, starvation, pool):
+        self.runner = runner
+        self.starvation = starvation
+        self.pool = pool
+        self.pending = []
+        self.running = {} #node -> job
+        self.wakeup = asyncio.Event()
+        self.workers = []
+
+    def start(self):
+        """Starts a worker task per node"""
+        self.workers = [asyncio.create_task(self.run(node)) for node in self.pool.nodes]
+
+    def wake(self):
+        """Makes idle workers look at the queue again, for when a node changes health"""
+        self.wakeup.set()
+
+    def submit(self, payload, user_id, checkpoint=None, modelprompts=True):
+        """Queues a job, await job.future for the result"""
+        job = ImageJob(payload, user_id, checkpoint, modelprompts)
+        self.pending.append(job)
+        self.wakeup.set()
+        return job
+
+    def ordered(self, node=None):
+        """Returns the pending jobs node can run, in the order it will run them: starving jobs, then its loaded checkpoint, then checkpoints no other node has loaded, then the rest.
+        Other checkpoints are grouped by their oldest job. With node None every job is ranked as if the least busy node picked next, for queue positions."""
+        if node is not None and not node.healthy and any(other.healthy for other in self.pool.nodes):
+            return []
+        now = time.monotonic()
+        oldest = {}
+        for job in self.pending: #pending is in arrival order so the first job seen per checkpoint is the oldest
+            oldest.setdefault(job.checkpoint, job.queued)
+        healthy = self.pool.healthy_nodes()
+        here = {node.checkpoint} if node is not None else {other.checkpoint for other in healthy}
+        elsewhere = {other.checkpoint for other in healthy if other is not node}
+        def rank(job):
+            if now - job.queued >= self.starvation:
+                return (0, job.queued, job.queued)
+            if job.checkpoint is None or job.checkpoint in here:
+                return (1, job.queued, job.queued)
+            if job.checkpoint not in elsewhere:
+                return (2, oldest[job.checkpoint], job.queued)
+            return (3, oldest[job.checkpoint], job.queued)
+        def runnable(job):
+            return node is None or not job.checkpoint or node.models is None or job.checkpoint in node.models #never send a node a checkpoint it does not have
+        return sorted(filter(runnable, self.pending), key=rank)
+
+    def available(self, checkpoint):
+        """True if a healthy node has checkpoint, or might because its catalog has not loaded yet"""
+        return not checkpoint or any(node.models is None or checkpoint in node.models for node in self.pool.healthy_nodes())
+
+    def reject_missing(self):
+        """Fails the pending jobs no healthy node can run, so they do not hold their slot until the deadline"""
+        for job in [job for job in self.pending if not self.available(job.checkpoint)]:
+            self.pending.remove(job)
+            if not job.future.done():
+                job.future.set_exception(MissingCheckpoint(job.checkpoint))
+
+    def position(self, job):
+        """Rough number of jobs that will run before this one"""
+        if job not in self.pending:
+            return 0
+        return self.ordered().index(job) // max(len(self.pool.healthy_nodes()), 1) + len(self.running)
+
+    async def run(self, node):
+        """Worker loop for one node"""
+        while True:
+            self.reject_missing() #a catalog refresh or a node going down can leave a checkpoint with nowhere to run
+            jobs = self.ordered(node)
+            if not jobs:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            job = jobs[0]
+            self.pending.remove(job)
+            if job.future.cancelled():
+                continue
+            self.running[node] = job
+            token = DEADLINE.set(job.deadline)
+            settingstoken = REQUEST_SETTINGS.set(job.settings)
+            runner = asyncio.create_task(self.runner(job, node)) #its own task so cancelling the job stops it without stopping the worker
+            REQUEST_SETTINGS.reset(settingstoken)
+            DEADLINE.reset(token)
+            job.future.add_done_callback(lambda future, runner=runner: runner.cancel() if future.cancelled() else None)
+            try:
+                await asyncio.wait({runner})
+                if runner.cancelled():
+                    log_event("img cancel", userid=job.user_id, node=node.url)
+                elif runner.exception() is not None:
+                    error = runner.exception()
+                    if isinstance(error, (BackendDown, BackendError)) and not job.future.done():
+                        job.future.set_exception(error) #the caller tells the user what the backend did
+                    else:
+                        log_event("img fail", level=logging.WARNING, userid=job.user_id, node=node.url, error=repr(error))
+                        if not job.future.done():
+                            job.future.set_result(None) #callers treat None as a failed generation
+                elif not job.future.done():
+                    job.future.set_result(runner.result())
+            finally:
+                if not runner.done():
+                    runner.cancel()
+                del self.running[node]
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300) #seconds
+
+class Metrics:
+    """Latency histograms and counters per command, stage and backend, rendered in the Prometheus text format or as a log summary"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {} #(name, labels) -> [count per bucket..., +Inf count, sum]
+        self.counters = {} #(name, labels) -> value
+        self.maxlag = 0.0
+
+    def observe(self, name, seconds, **labels):
+        """Adds one sample to a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                histogram[index] += 1
+                break
+        else: histogram[len(self.buckets)] += 1
+        histogram[-1] += seconds
+
+    def count(self, name, amount=1, **labels):
+        """Bumps a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextlib.contextmanager
+    def span(self, name, **labels):
+        """Times the block into metatron_<name>_seconds and counts it by outcome in metatron_<name>_total"""
+        start = time.perf_counter()
+        outcome = "ok"
+        try:
+            yield
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            self.observe(f'metatron_{name}_seconds', time.perf_counter() - start, **labels)
+            self.count(f'metatron_{name}_total', outcome=outcome, **labels)
+
+    async def sample_loop_lag(self, interval=0.5):
+        """Measures how late the event loop wakes a sleeping task, anything above zero is time something blocked the loop"""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(loop.time() - start - interval, 0.0)
+            self.maxlag = max(self.maxlag, lag)
+            self.observe("metatron_event_loop_lag_seconds", lag)
+
+    def quantile(self, histogram, fraction):
+        """Upper bound of the bucket holding the given fraction of samples"""
+        total = sum(histogram[:-1])
+        running = 0
+        for bound, bucket in zip(self.buckets, histogram):
+            running += bucket
+            if running >= fraction * total:
+                return bound
+        return float("inf")
+
+    @staticmethod
+    def escape(value):
+        """Escapes a label value"""
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def labeltext(self, labels):
+        """Prometheus label set"""
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{self.escape(value)}"' for key, value in labels) + "}"
+
+    def render(self, gauges):
+        """Prometheus text exposition of every histogram and counter, plus gauges given as a list of (component, labels, report dict)"""
+        lines = []
+        typed = set()
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name not in typed:
+                lines.append(f'# TYPE {name} histogram')
+                typed.add(name)
+            running = 0
+            for bound, bucket in zip(self.buckets, histogram):
+                running += bucket
+                lines.append(f'{name}_bucket{self.labeltext(labels + (("le", bound),))} {running}')
+            running += histogram[len(self.buckets)]
+            lines.append(f'{name}_bucket{self.labeltext(labels + (("le", "+Inf"),))} {running}')
+            lines.append(f'{name}_sum{self.labeltext(labels)} {histogram[-1]}')
+            lines.append(f'{name}_count{self.labeltext(labels)} {running}')
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                lines.append(f'# TYPE {name} counter')
+                typed.add(name)
+            lines.append(f'{name}{self.labeltext(labels)} {value}')
+        families = {} #every series of a gauge has to be listed together
+        for component, labels, report in gauges:
+            for field, value in report.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    families.setdefault(f'metatron_{component}_{field}', []).append(f'{self.labeltext(tuple(sorted(labels.items())))} {value}')
+        for name, series in families.items():
+            lines.append(f'# TYPE {name} gauge')
+            lines.extend(f'{name}{line}' for line in series)
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """One line per timed series with count, mean, p50 and p95, for the periodic log summary"""
+        lines = []
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            count = sum(histogram[:-1])
+            if not count:
+                continue
+            series = name.removeprefix("metatron_").removesuffix("_seconds") + "".join(f' {key}={value}' for key, value in labels)
+            lines.append(f'{series} n={count} mean={histogram[-1] / count:.3f}s p50<={self.quantile(histogram, 0.5)}s p95<={self.quantile(histogram, 0.95)}s')
+        lines.append(f'event loop max lag={self.maxlag:.3f}s')
+        self.maxlag = 0.0
+        return lines
+
+def summarize_html(html, url):
+    """Summarizes a webpage with LexRank, runs in the extraction pool"""
+    parser = HtmlParser.from_string(html, url, Tokenizer("english"))
+    stemmer = Stemmer("english")
+    summarizer = Summarizer(stemmer)
+    summarizer.stop_words = get_stop_words("english") #sumy summarizer setup stuff
+    compileddescription = ""
+    for sentence in summarizer(parser.document, 4):
+        compileddescription = f' {compileddescription} {sentence}'
+    return compileddescription
+
+def reduce_image(image_bytes, maxdim, quality):
+    """Decodes an image no larger than maxdim on its longest side and returns it as jpeg bytes, runs in the extraction pool"""
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft('RGB', (maxdim, maxdim)) #jpegs are scaled down by the decoder itself, other formats decode at full size and get thumbnailed below
+    image = image.convert('RGB')
+    image.thumbnail((maxdim, maxdim), Image.LANCZOS)
+    jpg_buffer = io.BytesIO()
+    image.save(jpg_buffer, format='JPEG', quality=quality, optimize=True)
+    return jpg_buffer.getvalue()
+
+class SnapshotTree(SettingsSnapshot, app_commands.CommandTree):
+    """Command tree whose slash commands each run on one settings snapshot"""
 
 class MyClient(discord.Client):
     """ Bot Class"""
     def __init__(self, *, intents: discord.Intents):
         super().__init__(intents=intents)
-        self.tree = app_commands.CommandTree(self)
-        self.defaultimage_payload = json.loads(SETTINGS["imagesettings"][0])
-        self.defaultword_payload = json.loads(SETTINGS["wordsettings"][0])
+        self.tree = SnapshotTree(self)
         self.models = []
         self.loras = []
         self.voices = []
+        self.sessions = {}
+        self.settings_watcher = None
+        self.catalog_watcher = None
+        self.catalog_cache = {}
+        self.moderator = None
+        self.metrics = Metrics()
+        self.metrics_tasks = []
+        self.metrics_runner = None
+        self.gates = {backend: AdmissionGate(backend, getattr(SETTINGS, f"{backend}concurrency"), SETTINGS.maxrequests) for backend in ("word", "image", "speak")}
+        self.history = None #the stores open in setup_hook, image pool workers import this file and must not touch them
+        self.chat_sessions = ChatSessions(SETTINGS.historyusers)
+        self.pools = {
+            "word": BackendPool("word", [BackendNode(url, SETTINGS.wordstreamapis[index % len(SETTINGS.wordstreamapis)]) for index, url in enumerate(SETTINGS.wordapis)], "/api/v1/model", SETTINGS.nodefailures, SETTINGS.breakerfailures, SETTINGS.breakercooldown),
+            "image": BackendPool("image", [BackendNode(url) for url in SETTINGS.imageapis], "/sdapi/v1/options", SETTINGS.nodefailures, SETTINGS.breakerfailures, SETTINGS.breakercooldown),
+            "speak": BackendPool("speak", [BackendNode(url) for url in SETTINGS.speakapis], "/voices", SETTINGS.nodefailures, SETTINGS.breakerfailures, SETTINGS.breakercooldown),
+        }
+        self.health_watcher = None
+        self.inflight = {} #message id -> {action: task working on its behalf}, cancelled when the message is deleted or the same action is pressed again
+        self.image_queue = ImageScheduler(self.run_image_job, SETTINGS.queuestarvation, self.pools["image"])
+        self.url_cache = None
+        self.media_cache = None
+        self.archive = None
+        self.extract_pool = ThreadPoolExecutor(max_workers=SETTINGS.extractworkers) #bounded pool for cpu bound url parsing
+        self.image_pool = ProcessPoolExecutor(max_workers=SETTINGS.imageworkers) #image compositing gets its own processes so big batches dont hold the GIL
+
+    def open_stores(self):
+        """Opens the history, caches and archive. Done at startup rather than on import so image pool workers, which import this file, never open the databases or clear the spill directory"""
+        self.history = HistoryStore(SETTINGS.historypath, SETTINGS.historyusers, SETTINGS.historyflush, SETTINGS.historyturns)
+        self.url_cache = TTLCache(SETTINGS.cachesize, SETTINGS.cachettl, SETTINGS.cachepath or None)
+        self.media_cache = MediaCache(SETTINGS.mediacachebytes, SETTINGS.mediaspillpath or None, SETTINGS.mediaspillbytes)
+        self.archive = GenerationArchive(SETTINGS.savepath, SETTINGS.archivepath, SETTINGS.archiveworkers, SETTINGS.archivesync) if SETTINGS.saveimages else None
 
     async def setup_hook(self): #Sync slash commands with discord servers Im on.
-        await client.load_models()
-        await client.load_loras()
-        await client.load_voices()
-        await self.tree.sync()
+        if LOG_WRITER.ident is None:
+            LOG_WRITER.start()
+        self.open_stores()
+        for backend in ("word", "image", "speak", "web"):
+            self.sessions[backend] = build_session() #one long lived pooled session per backend
+        self.catalog_cache = await asyncio.to_thread(self.read_catalogs)
+        cached = [kind for kind in self.catalog_loaders() if kind in self.catalog_cache]
+        for kind in cached:
+            self.apply_catalog(kind, self.catalog_cache[kind]) #start from the last known catalogs and refresh them in the background
+        health = asyncio.create_task(self.check_backends()) #also finds out which checkpoint each A1111 node has loaded
+        refreshed = len(cached) < len(self.catalog_loaders())
+        if refreshed:
+            await self.refresh_catalogs() #nothing to fall back on so wait for the first load, all catalogs at once
+        self.image_queue.start()
+        self.history.start()
+        if self.archive is not None:
+            self.archive.start()
+        if SETTINGS.settingsreload > 0:
+            self.settings_watcher = asyncio.create_task(self.watch_settings())
+        if SETTINGS.metricsport or SETTINGS.metricsinterval:
+            self.metrics_tasks.append(asyncio.create_task(self.metrics.sample_loop_lag()))
+        if SETTINGS.metricsport:
+            await self.serve_metrics()
+        if SETTINGS.metricsinterval:
+            self.metrics_tasks.append(asyncio.create_task(self.log_metrics()))
+        await self.sync_commands()
+        self.catalog_watcher = asyncio.create_task(self.watch_catalogs(refreshnow=not refreshed))
+        await health
+        if SETTINGS.healthinterval > 0:
+            self.health_watcher = asyncio.create_task(self.watch_backends())
+
+    def metric_gauges(self):
+        """Current queue, cache and history state for the metrics endpoint"""
+        gauges = [("gate", {"backend": backend}, gate.report()) for backend, gate in self.gates.items()]
+        gauges.extend(("pool", {"backend": backend}, pool.report()) for backend, pool in self.pools.items())
+        gauges.extend(("node", {"backend": backend, "node": node.url}, node.report()) for backend, pool in self.pools.items() for node in pool.nodes)
+        gauges.append(("image_queue", {}, {"pending": len(self.image_queue.pending), "running": len(self.image_queue.running)}))
+        gauges.append(("url_cache", {}, self.url_cache.report()))
+        gauges.append(("media_cache", {}, self.media_cache.report()))
+        gauges.append(("history", {}, self.history.report()))
+        gauges.append(("chat_sessions", {}, self.chat_sessions.report()))
+        if self.archive is not None:
+            gauges.append(("archive", {}, self.archive.report()))
+        return gauges
+
+    async def serve_metrics(self):
+        """Serves /metrics in the Prometheus text format on metricshost:metricsport"""
+        async def metrics_handler(request):
+            return aiohttp.web.Response(text=self.metrics.render(self.metric_gauges()), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+        app = aiohttp.web.Application()
+        app.router.add_get("/metrics", metrics_handler)
+        self.metrics_runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self.metrics_runner.setup()
+        await aiohttp.web.TCPSite(self.metrics_runner, SETTINGS.metricshost, SETTINGS.metricsport).start()
+        log_event("metrics", message=f"serving http://{SETTINGS.metricshost}:{SETTINGS.metricsport}/metrics")
+
+    async def log_metrics(self):
+        """Logs a latency summary every metricsinterval seconds"""
+        while True:
+            await asyncio.sleep(SETTINGS.metricsinterval)
+            for line in self.metrics.summary():
+                log_event("metrics", message=line)
+            for component, _, report in self.metric_gauges():
+                log_event("metrics", message=component, **report)
+
+    async def watch_settings(self):
+        """Reloads settings.cfg when it changes. The new settings replace the old in a single assignment so running requests keep the snapshot they started with."""
+        global SETTINGS
+        lastmodified = os.stat("settings.cfg").st_mtime
+        while True:
+            await asyncio.sleep(SETTINGS.settingsreload)
+            try:
+                modified = os.stat("settings.cfg").st_mtime
+                if modified == lastmodified:
+                    continue
+                lastmodified = modified
+                newsettings = await asyncio.to_thread(load_settings, "settings.cfg")
+            except (OSError, ValueError) as error:
+                log_event("settings", message="reload failed, keeping the old settings", level=logging.ERROR, error=str(error))
+                continue
+            SETTINGS = newsettings
+            for backend, gate in self.gates.items(): #queue limits can change live, pools and sessions need a restart
+                gate.limit = getattr(SETTINGS, f"{backend}concurrency")
+                gate.peruser = SETTINGS.maxrequests
+                gate.dispatch()
+            self.image_queue.starvation = SETTINGS.queuestarvation
+            for pool in self.pools.values(): #the node lists themselves need a restart
+                pool.maxfailures = SETTINGS.nodefailures
+                pool.breakerfailures = SETTINGS.breakerfailures
+                pool.breakercooldown = SETTINGS.breakercooldown
+            log_event("settings", message="reloaded settings.cfg")
+
+    async def close(self):
+        """Closes the backend sessions on shutdown"""
+        for session in self.sessions.values():
+            await session.close()
+        self.extract_pool.shutdown(wait=False, cancel_futures=True)
+        self.image_pool.shutdown(wait=False, cancel_futures=True)
+        if self.url_cache is not None:
+            self.url_cache.close()
+        if self.history is not None:
+            await self.history.close()
+        if self.archive is not None:
+            await self.archive.close()
+        for task in self.metrics_tasks:
+            task.cancel()
+        if self.catalog_watcher is not None:
+            self.catalog_watcher.cancel()
+        if self.health_watcher is not None:
+            self.health_watcher.cancel()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        await super().close()
 
     async def on_ready(self):
         """Logs to the console when fully connected to discord"""
-        logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("login", "cyan")}    | {colored(client.user, "yellow")}, {colored(client.user.id, "light_yellow")}') #Tell console login was successful
+        log_event("login", client.user) #Tell console login was successful
+
+    async def on_raw_message_delete(self, payload):
+        """Stops whatever is still being generated for a message that got deleted"""
+        self.cancel_work(payload.message_id)
+
+    @contextlib.contextmanager
+    def track(self, message_id, action):
+        """Registers the current task as the action running for message_id for the duration of the block, cancelling the same action if it was already running for it"""
+        if message_id is None:
+            yield
+            return
+        task = asyncio.current_task()
+        actions = self.inflight.setdefault(message_id, {})
+        previous = actions.get(action)
+        if previous is not None and previous is not task:
+            previous.cancel() #pressing the same button again supersedes the old press
+            self.metrics.count("metatron_cancelled_total", reason="superseded")
+        actions[action] = task
+        try:
+            yield
+        finally:
+            actions = self.inflight.get(message_id, {})
+            if actions.get(action) is task:
+                del actions[action]
+                if not actions:
+                    del self.inflight[message_id]
+
+    def cancel_work(self, message_id):
+        """Cancels everything running for a message"""
+        for task in self.inflight.pop(message_id, {}).values():
+            if task is not asyncio.current_task():
+                task.cancel()
+                self.metrics.count("metatron_cancelled_total", reason="deleted")
+
+    @contextlib.asynccontextmanager
+    async def backend_guard(self, send, backend):
+        """Turns an open breaker, an error reply, a missing checkpoint or a missed deadline inside the block into a message for the user instead of an error"""
+        try:
+            yield
+        except BackendDown as error:
+            self.metrics.count("metatron_breaker_rejections_total", backend=error.backend)
+            await send(str(error))
+        except BackendError as error:
+            self.metrics.count("metatron_backend_errors_total", backend=error.backend, status=str(error.status))
+            await send(str(error))
+        except MissingCheckpoint as error:
+            log_event("img fail", level=logging.WARNING, message="no node has the checkpoint", checkpoint=error.checkpoint)
+            await send(str(error))
+        except asyncio.TimeoutError as error:
+            self.metrics.count("metatron_deadline_exceeded_total", backend=backend)
+            log_event("deadline", message=f"{backend} request dropped", level=logging.WARNING, error=repr(error))
+            await send(f'The {backend} backend took too long, the request was dropped.')
+
+    async def check_backends(self):
+        """Health checks the enabled backend pools, A1111 replies also say which checkpoint each node has loaded"""
+        def inspect_image(node, data):
+            if node not in self.image_queue.running: #a job may be swapping, it knows better than a reply that could be from before the swap
+                node.checkpoint = data.get("sd_model_checkpoint") or None
+        checks = []
+        if SETTINGS.enableword:
+            checks.append(self.pools["word"].check(self.sessions["word"], SETTINGS.healthtimeout))
+        if SETTINGS.enableimage:
+            checks.append(self.pools["image"].check(self.sessions["image"], SETTINGS.healthtimeout, inspect_image))
+        if SETTINGS.enablespeak:
+            checks.append(self.pools["speak"].check(self.sessions["speak"], SETTINGS.healthtimeout))
+        await asyncio.gather(*checks)
+        self.image_queue.wake()
+
+    async def watch_backends(self):
+        """Health checks the backends every healthinterval seconds"""
+        while True:
+            await asyncio.sleep(SETTINGS.healthinterval)
+            await self.check_backends()
+
+    async def gather_catalog(self, backend, path):
+        """GETs path from every healthy node of a backend at once, returns [(node, reply)] in node order for the nodes that answered. Raises if none did."""
+        pool = self.pools[backend]
+        async def fetch(node):
+            async with pool.lease(node):
+                async with self.sessions[backend].get(f'{node.url}{path}') as response:
+                    return node, await response.json()
+        results = await asyncio.gather(*(fetch(node) for node in pool.healthy_nodes()), return_exceptions=True)
+        answered = [result for result in results if not isinstance(result, BaseException)]
+        if not answered:
+            raise results[0]
+        return answered
 
     async def load_models(self):
-        """Get list of models for user interface"""
-        if SETTINGS["enableimage"][0] == "True":
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f'{SETTINGS["imageapi"][0]}/sdapi/v1/sd-models') as response:
-                    response_data = await response.json()
-                    for title in response_data:
-                        self.models.append(app_commands.Choice(name=title["title"], value=title["title"]))
-            return self.models
+        """Get list of models for user interface, merged across the A1111 nodes"""
+        titles = {}
+        for node, response_data in await self.gather_catalog("image", "/sdapi/v1/sd-models"):
+            node.models = frozenset(title["title"] for title in response_data)
+            titles.update(dict.fromkeys(title["title"] for title in response_data))
+        self.image_queue.wake()
+        return [[title, title] for title in titles]
 
     async def load_loras(self):
-        """Get list of loras for user interface"""
-        if SETTINGS["enableimage"][0] == "True":
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f'{SETTINGS["imageapi"][0]}/sdapi/v1/loras') as response:
-                    response_data = await response.json()
-                    for name in response_data:
-                        self.loras.append(app_commands.Choice(name=name["name"], value=name["name"]))
-            return self.loras
+        """Get list of loras for user interface, merged across the A1111 nodes"""
+        names = {}
+        for _, response_data in await self.gather_catalog("image", "/sdapi/v1/loras"):
+            names.update(dict.fromkeys(name["name"] for name in response_data))
+        return [[name, name] for name in names]
 
     async def load_voices(self):
-        """Get list of voices for user interface"""
-        if SETTINGS["enablespeak"][0] == "True":
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f'{SETTINGS["speakapi"][0]}/voices') as response:
-                    response_data = await response.json()
-                    voices_list = response_data.get('voices', [])
-                    for voice in voices_list:
-                        self.voices.append(app_commands.Choice(name=voice, value=voice))
-                    self.voices.append(app_commands.Choice(name="Base voice", value="None"))
-            return self.voices
+        """Get list of voices for user interface, merged across the Bark nodes"""
+        voices = {}
+        for _, response_data in await self.gather_catalog("speak", "/voices"):
+            voices.update(dict.fromkeys(response_data.get('voices', [])))
+        return [[voice, voice] for voice in voices] + [["Base voice", "None"]]
+
+    def catalog_loaders(self):
+        """Catalog name -> loader for the enabled backends"""
+        loaders = {}
+        if SETTINGS.enableimage:
+            loaders["models"] = self.load_models
+            loaders["loras"] = self.load_loras
+        if SETTINGS.enablespeak:
+            loaders["voices"] = self.load_voices
+        return loaders
+
+    def apply_catalog(self, kind, entries):
+        """Swaps a catalogs choices in place since the command decorators hold on to these lists, returns True if anything changed"""
+        choices = getattr(self, kind)
+        if [[choice.name, choice.value] for choice in choices] == entries:
+            return False
+        choices[:] = [app_commands.Choice(name=name, value=value) for name, value in entries]
+        return True
+
+    async def refresh_catalogs(self):
+        """Fetches every catalog at once, each with its own timeout. A catalog that fails keeps its last known entries. Returns True if anything changed."""
+        loaders = self.catalog_loaders()
+        results = await asyncio.gather(*(asyncio.wait_for(loader(), SETTINGS.catalogtimeout) for loader in loaders.values()), return_exceptions=True)
+        changed = False
+        for kind, result in zip(loaders, results):
+            if isinstance(result, Exception):
+                log_event("catalog", message=f"could not load {kind}, keeping the last known list", level=logging.WARNING, error=repr(result))
+                continue
+            if self.apply_catalog(kind, result):
+                self.catalog_cache[kind] = result
+                changed = True
+        if changed:
+            await asyncio.to_thread(self.write_catalogs, dict(self.catalog_cache))
+        return changed
+
+    def read_catalogs(self):
+        """Last known catalogs and command sync hash from disk"""
+        try:
+            with open(SETTINGS.catalogpath, "r", encoding="utf-8") as catalog_file:
+                return json.load(catalog_file)
+        except (OSError, ValueError):
+            return {}
+
+    def write_catalogs(self, catalogs):
+        """Saves the catalogs and command sync hash, through a temp file so a crash cant leave half a file"""
+        with open(f'{SETTINGS.catalogpath}.tmp', "w", encoding="utf-8") as catalog_file:
+            json.dump(catalogs, catalog_file)
+        os.replace(f'{SETTINGS.catalogpath}.tmp', SETTINGS.catalogpath)
+
+    def command_definition(self, command):
+        """The json discord gets for a command. to_dict only takes the tree from discord.py 2.4 on, 2.3 takes nothing"""
+        if len(inspect.signature(command.to_dict).parameters):
+            return command.to_dict(self.tree)
+        return command.to_dict()
+
+    async def sync_commands(self):
+        """Syncs the slash commands with discord, skipped when the definitions and choices hash the same as at the last sync"""
+        definitions = json.dumps([self.command_definition(command) for command in self.tree.get_commands()], sort_keys=True)
+        synchash = hashlib.sha256(f'{self.application_id}:{definitions}'.encode()).hexdigest()
+        if synchash == self.catalog_cache.get("synchash"):
+            log_event("sync", message="commands unchanged, skipping sync")
+            return
+        await self.tree.sync()
+        self.catalog_cache["synchash"] = synchash
+        await asyncio.to_thread(self.write_catalogs, dict(self.catalog_cache))
+        log_event("sync", message="synced commands")
+
+    async def watch_catalogs(self, refreshnow):
+        """Refreshes the catalogs every catalogrefresh seconds so new checkpoints, loras and voices show up without a restart.
+        refreshnow does the first refresh straight away, for when the bot started from the disk cache."""
+        while True:
+            if refreshnow:
+                try:
+                    if await self.refresh_catalogs():
+                        await self.sync_commands()
+                except (discord.HTTPException, OSError) as error:
+                    log_event("catalog", message="refresh failed", level=logging.WARNING, error=repr(error))
+            refreshnow = True
+            if not SETTINGS.catalogrefresh:
+                return
+            await asyncio.sleep(SETTINGS.catalogrefresh)
 
     async def on_message(self, message):
         """Function that watches if bot is tagged and if it is makes a request to ooba and posts response"""
         if message.author == self.user:
             return #ignores messages from ourselves for the odd edge case where the bot somehow tags or replies to itself.
-        if str(message.author.id) in SETTINGS.get("bannedusers", [""])[0].split(','):
+        settings = snapshot_settings() #one snapshot per message so a settings reload mid request cant mix old and new values
+        if message.author.id in settings.bannedusers:
             return  # Exit the function if the author is banned
-        if not global_interaction_history.get(message.author.id):
-            global_interaction_history[message.author.id] = [] #Creates a blank interaction history if it doesnt already exist.
         if self.user.mentioned_in(message):
-            if SETTINGS["enableword"][0] != "True":
+            if not settings.enableword:
                 await message.channel.send("LLM generation is currently disabled.")
                 return #check if LLM generation is enabled
-            async with message.channel.typing(): #Put the "typing...." discord status up
-                request = request if "request" in locals() else self.defaultword_payload #set up default payload request if it doesnt exist
-                request["history"]["internal"] = request["history"]["visible"] = global_interaction_history[message.author.id] #Load user interaction history into payload
-                taggedmessage = re.sub(r'<[^>]+>', '', message.content).lstrip() #strips The discord name from the users prompt.
-                processedmessage = taggedmessage
-                if processedmessage == "forget":
-                    global_interaction_history[message.author.id] = []
-                    await message.channel.send("History wiped")
-                    logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("forget", "cyan")}   | {colored(message.author.name, "yellow")}:{colored(message.author.id, "light_yellow")} | {colored(message.guild, "red")}:{colored(message.channel, "light_red")}')
-                    return
-                if SETTINGS["enableurls"][0] == "True":
-                    urls = re.findall(r'(https?://[^\s]+)', processedmessage)  # Check messages for URLs.
-                    for url in urls:
-                        extracted_text = await self.extract_text_from_url(url)
-                        processedmessage = f'{processedmessage}. {extracted_text}'
-                    for attachment in message.attachments:
-                        extracted_text = await self.extract_text_from_url(attachment.url)
-                        processedmessage = f'{processedmessage}. {extracted_text}'
-                    request["user_input"] = processedmessage #load the user prompt into the api payload
-                else: request["user_input"] = taggedmessage #load the user prompt into the api payload
-                processedreply = await client.generate_word(request, message.author.id, taggedmessage)
-                await message.channel.send(f"{message.author.mention} {processedreply}", view=Wordgenbuttons(request, message.author.id, taggedmessage)) #send message to channel
-            logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("wordgen", "cyan")}  | {colored(message.author.name, "yellow")}:{colored(message.author.id, "light_yellow")} | {colored(message.guild, "red")}:{colored(message.channel, "light_red")} | {colored(taggedmessage, "light_magenta")}')
+            with self.metrics.span("command", command="chat"):
+                async with message.channel.typing(): #Put the "typing...." discord status up
+                    taggedmessage = re.sub(r'<[^>]+>', '', message.content).lstrip() #strips The discord name from the users prompt.
+                    processedmessage = taggedmessage
+                    if processedmessage == "forget":
+                        async with self.chat_sessions.hold(message.author.id):
+                            await self.history.wipe(message.author.id)
+                        await message.channel.send("History wiped")
+                        log_event("forget", message.author, message.guild, message.channel)
+                        return
+                    if settings.enableurls:
+                        urls = re.findall(r'(https?://[^\s]+)', processedmessage)  # Check messages for URLs.
+                        urls.extend(attachment.url for attachment in message.attachments)
+                        for extracted_text in await self.extract_all(urls): #fetches every link and attachment concurrently
+                            processedmessage = f'{processedmessage}. {extracted_text}'
+                    request = ChatRequest(settings.wordsettings, processedmessage) #the user prompt on top of the default payload
+                    with self.track(message.id, "chat"): #deleting the message stops the reply
+                        async with self.backend_guard(message.reply, "word"), self.chat_sessions.hold(message.author.id): #this users other chats wait so the history is read and written by one generation at a time
+                            await client.send_word(request, message.author.id, taggedmessage, message.channel.send, message.author.mention, notify=queue_notifier(message.reply, "chat")) #send message to channel
+            log_event("wordgen", message.author, message.guild, message.channel, prompt=taggedmessage)
+
+    async def word_payload(self, request, user_id):
+        """Builds the api payload with the users history, trimmed to whatever context is left after the reply and the new message"""
+        settings = current_settings()
+        budget = settings.contexttokens - int(request.template.get("max_new_tokens", 0)) - estimate_tokens(request.user_input)
+        with self.metrics.span("stage", stage="history", backend="bot"):
+            return request.payload(await self.history.window(user_id, budget))
+
+    async def send_word(self, request, user_id, taggedmessage, send, mention, prevresponse='', notify=None):
+        """Waits for a chat slot, then generates a reply and posts it with send. With streamreplies on the first chunk is posted right away and edited in place as the rest arrives.
+        prevresponse is stripped from what is shown, for continues. Callers hold the users chat session. Returns the full reply.
+        Raises BackendDown straight away while ooba is down and asyncio.TimeoutError if the whole thing takes longer than worddeadline."""
+        settings = current_settings()
+        self.pools["word"].admit()
+        return await with_deadline(settings.worddeadline, self.queue_word(request, user_id, taggedmessage, send, mention, prevresponse, notify))
+
+    async def queue_word(self, request, user_id, taggedmessage, send, mention, prevresponse, notify):
+        """Waits for a chat slot and posts the reply, see send_word"""
+        async with self.gates["word"].slot(user_id, notify):
+            return await self.post_word(request, user_id, taggedmessage, send, mention, prevresponse)
+
+    async def post_word(self, request, user_id, taggedmessage, send, mention, prevresponse):
+        """Generates and posts a reply, see send_word"""
+        settings = current_settings()
+        view = Wordgenbuttons(request, user_id, taggedmessage)
+        if not settings.streamreplies:
+            processedreply = await self.generate_word(request, user_id, taggedmessage)
+            with self.metrics.span("stage", stage="upload", backend="discord"):
+                await send(f"{mention} {processedreply.replace(prevresponse, '')}", view=view)
+            return processedreply
+        interval = settings.streaminterval #discord rate limits message edits so only edit this often
+        sent = None
+        lastedit = 0.0
+        processedreply = ""
+        async for processedreply in self.stream_word(request, user_id, taggedmessage):
+            shownreply = processedreply.replace(prevresponse, '')
+            if not shownreply.strip():
+                continue
+            if sent is None:
+                sent = await send(f"{mention} {shownreply}")
+                lastedit = time.monotonic()
+            elif time.monotonic() - lastedit >= interval:
+                await sent.edit(content=f"{mention} {shownreply}")
+                lastedit = time.monotonic()
+        shownreply = processedreply.replace(prevresponse, '')
+        if sent is None:
+            await send(f"{mention} {shownreply}", view=view)
+        else: await sent.edit(content=f"{mention} {shownreply}", view=view) #final text and the buttons go on once the stream is done
+        return processedreply
+
+    async def stream_word(self, request, user_id, taggedmessage):
+        """Streaming word generation over oobas chat-stream websocket, yields the reply so far and saves the finished reply to history. Raises BackendError if the stream has no text"""
+        settings = current_settings()
+        payload = await self.word_payload(request, user_id)
+        if settings.debug:
+            log_payload("word stream payload", payload)
+        processedreply = ""
+        with self.metrics.span("stage", stage="chatstream", backend="word"):
+            async with self.pools["word"].lease() as node:
+                try:
+                    websocket = await self.sessions["word"].ws_connect(f'{node.streamurl}/api/v1/chat-stream')
+                except aiohttp.WSServerHandshakeError as error:
+                    raise BackendError("word", error.status) from error
+                async with websocket:
+                    await websocket.send_json(payload)
+                    async for wsmessage in websocket:
+                        if wsmessage.type != aiohttp.WSMsgType.TEXT:
+                            break
+                        data = json.loads(wsmessage.data)
+                        if data["event"] == "text_stream":
+                            processedreply = data["history"]["internal"][-1][1]
+                            yield processedreply
+                        elif data["event"] == "stream_end":
+                            break
+                if not processedreply: #closed or errored before any text, there is no reply to post or remember
+                    raise BackendError("word", None, "the reply stream ended without any text")
+        new_entry = [taggedmessage, processedreply] #prepare entry to be placed into the users history
+        await self.history.append(user_id, new_entry)
 
     async def generate_word(self, request, user_id, taggedmessage):
         """word generation api call"""
-        if SETTINGS["debug"][0] == 'True':
-            logging.debug(f'DEBUG WORD PAYLOAD BEGIN: {colored(json.dumps(request, indent=1), "light_blue")}')
-        async with aiohttp.ClientSession() as session: #make the api request
-            async with session.post(f'{SETTINGS["wordapi"][0]}/api/v1/chat', json=request, timeout=None) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    if SETTINGS["debug"][0] == 'True':
-                        logging.debug(f'DEBUG WORD PAYLOAD RESPONSE BEGIN: {colored(json.dumps(result, indent=1), "light_blue")}')
-                    processedreply = result["results"][0]["history"]["internal"][-1][1] #load said reply
-                    new_entry = [taggedmessage, processedreply] #prepare entry to be placed into the users history
-                    global_interaction_history[user_id].append(new_entry) #update user history
-                    if len(global_interaction_history[user_id]) > 10:
-                        global_interaction_history[user_id].pop(0) #remove oldest result in history once maximum is reached
+        settings = current_settings()
+        payload = await self.word_payload(request, user_id) #Load user interaction history into payload
+        if settings.debug:
+            log_payload("word payload", payload)
+        with self.metrics.span("stage", stage="chat", backend="word"):
+            async with self.pools["word"].lease() as node, self.sessions["word"].post(f'{node.url}/api/v1/chat', json=payload) as response: #make the api request on the least busy ooba node
+                if response.status != 200:
+                    raise BackendError("word", response.status)
+                result = await response.json()
+        if settings.debug:
+            log_payload("word response", result)
+        processedreply = result["results"][0]["history"]["internal"][-1][1] #load said reply
+        new_entry = [taggedmessage, processedreply] #prepare entry to be placed into the users history
+        await self.history.append(user_id, new_entry) #update user history, the store drops the oldest entry once maximum is reached
         return processedreply
 
-    async def generate_image(self, payload, user_id):
-        """image generation api call"""
-        if user_id in concurrent_requests_per_user and concurrent_requests_per_user[user_id] >= int(SETTINGS["maxrequests"][0]):
-            return None  # User has reached the limit, do not allow another request
-        concurrent_requests_per_user[user_id] = concurrent_requests_per_user.get(user_id, 0) + 1
+    async def generate_image(self, payload, user_id, node):
+        """image generation api call on an A1111 node, returns a ready to upload discord.File or None. Raises BackendError on an error reply"""
+        settings = current_settings()
+        if settings.debug:
+            log_payload("image payload", payload)
         try:
-            if SETTINGS["debug"][0] == 'True':
-                logging.debug(f'DEBUG IMAGE PAYLOAD BEGIN: {colored(json.dumps(payload, indent=1), "light_blue")}')
-            async with aiohttp.ClientSession() as session:
-                async with session.post(f'{SETTINGS["imageapi"][0]}/sdapi/v1/txt2img', json=payload) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if SETTINGS["debug"][0] == 'True':
-                            logging.debug(f'DEBUG IMAGE RESPONSE BEGIN: {colored(response, "light_blue")}')
-                        if "images" in data: # Tile and compile images into a grid
-                            image_list = [Image.open(io.BytesIO(base64.b64decode(i.split(",", 1)[0])) ) for i in data['images']]
-                            width, height = image_list[0].size
-                            num_images_per_row = math.ceil(math.sqrt(len(image_list)))
-                            num_rows = math.ceil(len(image_list) / num_images_per_row)
-                            composite_width = num_images_per_row * width
-                            composite_height = num_rows * height
-                            composite_image = Image.new('RGB', (composite_width, composite_height))
-                            for idx, image in enumerate(image_list):
-                                row, col = divmod(idx, num_images_per_row)
-                                composite_image.paste(image, (col * width, row * height))
-                            composite_image_bytes = io.BytesIO()
-                            composite_image.save(composite_image_bytes, format='PNG')
-                            if SETTINGS["saveimages"][0] == "True":
-                                current_datetime_str = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-                                sanitized_prompt = re.sub(r'[\/:*?"<>|]', '', payload["prompt"])
-                                basepath = f'{SETTINGS["savepath"][0]}/{current_datetime_str}-{sanitized_prompt}'
-                                truncatedpath = basepath[:200]
-                                imagesavepath = f'{truncatedpath}.png'
-                                with open(imagesavepath, "wb") as output_file:
-                                    output_file.write(composite_image_bytes.getvalue())
-                            composite_image_bytes.seek(0)
-                    else: return None
-        finally: # Decrement the count of concurrent requests for the user
-            if user_id in concurrent_requests_per_user:
-                concurrent_requests_per_user[user_id] -= 1
-        return composite_image_bytes
+            with self.metrics.span("stage", stage="txt2img", backend="image"):
+                async with self.sessions["image"].post(f'{node.url}/sdapi/v1/txt2img', json=payload) as response:
+                    if response.status != 200:
+                        raise BackendError("image", response.status)
+                    data = await response.json()
+        except asyncio.CancelledError: #dropping the connection does not stop A1111, it has to be told
+            await self.interrupt_image(node)
+            raise
+        if settings.debug:
+            log_payload("image response", {**data, "status": response.status})
+        if "images" not in data:
+            return None
+        with self.metrics.span("stage", stage="composite", backend="bot"):
+            upload_bytes, upload_format, full_bytes, full_format = await asyncio.get_running_loop().run_in_executor(self.image_pool, composite_images, data['images'], settings.imageformat, settings.imagequality, settings.imagecompression, settings.maxupload) #decode, tile and encode in a worker process
+        if settings.saveimages and self.archive is not None:
+            try:
+                seed = json.loads(data.get("info") or "{}").get("seed") #the seed A1111 actually used, random seeds included
+            except (ValueError, AttributeError):
+                seed = None
+            self.archive.save(full_bytes, IMAGE_EXTENSIONS[full_format], payload, seed, node.checkpoint, user_id) #the archive always gets the full quality encode, written in the background
+        return discord.File(io.BytesIO(upload_bytes), filename=f'composite_image.{IMAGE_EXTENSIONS[upload_format]}')
+
+    async def interrupt_image(self, node):
+        """Tells an A1111 node to stop the gen it is running, for jobs cancelled mid gen"""
+        settings = current_settings()
+        try:
+            async with self.sessions["image"].post(f'{node.url}/sdapi/v1/interrupt', timeout=aiohttp.ClientTimeout(total=settings.healthtimeout)) as response:
+                if response.status != 200:
+                    raise ValueError(f'interrupt returned {response.status}')
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+            log_event("interrupt", message=f"could not interrupt {node.url}", level=logging.WARNING, error=repr(error))
+            return
+        self.metrics.count("metatron_image_interrupts_total")
+        log_event("interrupt", message=f"stopped the gen on {node.url}")
+
+    async def queue_image(self, payload, user_id, checkpoint=None, modelprompts=True, notify=None):
+        """Waits for an image slot, then hands the job to the scheduler and waits for it to finish. Returns the finished job.
+        Fixed seed payloads that were generated before are served from the archive without queueing.
+        Raises BackendDown straight away while A1111 is down, MissingCheckpoint if no node has checkpoint and asyncio.TimeoutError if the job takes longer than imagedeadline, which also stops it on the node."""
+        settings = current_settings()
+        archived = await self.reuse_image(payload, user_id, checkpoint, modelprompts)
+        if archived is not None:
+            return archived
+        self.pools["image"].admit()
+        if not self.image_queue.available(checkpoint):
+            raise MissingCheckpoint(checkpoint)
+        return await with_deadline(settings.imagedeadline, self.run_queued_image(payload, user_id, checkpoint, modelprompts, notify))
+
+    async def run_queued_image(self, payload, user_id, checkpoint, modelprompts, notify):
+        """Waits for an image slot and the scheduler, see queue_image"""
+        async with self.gates["image"].slot(user_id, notify) as waited:
+            job = self.image_queue.submit(payload, user_id, checkpoint, modelprompts)
+            position = self.image_queue.position(job)
+            if position > 0 and notify is not None and not waited: #only tell the user once
+                await notify(position + 1)
+            await job.future
+        return job
+
+    async def reuse_image(self, payload, user_id, checkpoint, modelprompts):
+        """Returns a finished job serving an archived gen of the same fixed seed payload and model, or None if it has to be generated"""
+        settings = current_settings()
+        if self.archive is None or not settings.saveimages or not settings.archivereuse or int(payload.get("seed", -1)) < 0:
+            return None
+        model = checkpoint
+        if model is None: #whatever is loaded, only knowable when every node has the same checkpoint
+            loaded = {node.checkpoint for node in self.pools["image"].healthy_nodes()}
+            model = loaded.pop() if len(loaded) == 1 else None
+        if model is None:
+            return None
+        final = {**payload, **self.model_prompts(payload, model)} if modelprompts else payload
+        archived = await self.archive.lookup(final, model)
+        if archived is None:
+            return None
+        data, path = archived
+        imageformat = {extension: name for name, extension in IMAGE_EXTENSIONS.items()}.get(path.rsplit(".", 1)[-1], "PNG")
+        if len(data) > settings.maxupload:
+            with self.metrics.span("stage", stage="composite", backend="bot"):
+                data, imageformat = await asyncio.get_running_loop().run_in_executor(self.image_pool, refit_upload, data, imageformat, settings.imagequality, settings.imagecompression, settings.maxupload)
+        payload.update(final)
+        job = ImageJob(payload, user_id, checkpoint, modelprompts)
+        job.model = model
+        job.future.set_result(discord.File(io.BytesIO(data), filename=f'composite_image.{IMAGE_EXTENSIONS[imageformat]}'))
+        log_event("archive", message="served an earlier gen", userid=user_id, path=path)
+        return job
+
+    @staticmethod
+    def model_prompts(payload, model):
+        """Returns the prompt and negative with the mandatory model prompts added"""
+        settings = current_settings()
+        if model not in settings.modelprompts:
+            return {}
+        modelprompt, modelnegative = settings.modelprompts[model]
+        merged = {}
+        if modelprompt:
+            merged["prompt"] = f"{modelprompt},{payload['prompt']}" #Combine the model defaults with the user choices
+        if modelnegative:
+            merged["negative_prompt"] = f"{modelnegative},{payload['negative_prompt']}"
+        return merged
+
+    async def send_media(self, send, file, payload=None, **kwargs):
+        """Posts a generated file and keeps its bytes in the media cache under the new message id"""
+        settings = current_settings()
+        data = file.fp.getvalue()
+        with self.metrics.span("stage", stage="upload", backend="discord"):
+            message = await send(file=file, **kwargs)
+        if message is not None:
+            await self.media_cache.put(message.id, data, file.filename, payload)
+            if settings.debug:
+                log_event("media", level=logging.DEBUG, **self.media_cache.report())
+        return message
+
+    async def fetch_media(self, message):
+        """Returns (bytes, filename) for the media on one of our messages, from the media cache or the CDN on a miss"""
+        cached = await self.media_cache.get(message.id)
+        if cached is not None:
+            return cached[0], cached[1]
+        async with self.sessions["web"].get(message.attachments[0].url) as response:
+            if response.status == 200:
+                return await response.read(), message.attachments[0].filename
+        return None, None
+
+    async def generate_speech(self, params, user_id, notify=None):
+        """Waits for a speak slot, then synthesises the text in sentence chunks at once across the speak backends and joins them in order.
+        Returns (audio file object, file extension), or (None, None) if any chunk failed.
+        Raises BackendDown straight away while Bark is down, BackendError if it answers with an error and asyncio.TimeoutError if it takes longer than speakdeadline."""
+        settings = current_settings()
+        self.pools["speak"].admit()
+        return await with_deadline(settings.speakdeadline, self.speak_chunks(params, user_id, notify))
+
+    async def speak_chunks(self, params, user_id, notify):
+        """Synthesises and joins the chunks, see generate_speech"""
+        settings = current_settings()
+        chunks = split_speech(params['inputstring'], settings.speakchunkchars)
+        if not chunks:
+            return None, None
+        limit = asyncio.Semaphore(settings.speakparallel)
+        async def synthesise(index, chunk):
+            async with limit:
+                with self.metrics.span("stage", stage="txt2wav", backend="speak"):
+                    async with self.pools["speak"].lease() as node, self.sessions["speak"].get(f'{node.url}/txt2wav', params={**params, 'inputstring': chunk}) as response: #each chunk goes to the least busy Bark node
+                        if response.status != 200:
+                            raise BackendError("speak", response.status)
+                        return await response.read()
+        async with self.gates["speak"].slot(user_id, notify):
+            tasks = [asyncio.create_task(synthesise(index, chunk)) for index, chunk in enumerate(chunks)]
+            try:
+                wavs = await asyncio.gather(*tasks)
+                pieces = join_wavs(wavs) if len(wavs) > 1 else [wavs[0]]
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+                log_event("speakgen", message="speech failed", level=logging.ERROR, error=repr(error))
+                return None, None
+            finally:
+                for task in tasks: #one failed chunk means the rest are wasted work
+                    task.cancel()
+        with self.metrics.span("stage", stage="encode", backend="bot"):
+            return await encode_speech(pieces, settings.speakformat)
+
+    async def run_image_job(self, job, node):
+        """Swaps checkpoints on the node if the job needs it, applies the mandatory model prompts and generates the image"""
+        settings = current_settings()
+        async with self.pools["image"].lease(node):
+            if job.checkpoint and job.checkpoint != node.checkpoint:
+                model_payload = {"sd_model_checkpoint": job.checkpoint}
+                with self.metrics.span("stage", stage="modelswap", backend="image"):
+                    async with self.sessions["image"].post(f'{node.url}/sdapi/v1/options', json=model_payload) as response: #make the api request to change to the requested model
+                        if response.status != 200: #generating anyway would give the user the wrong model
+                            raise BackendError("image", response.status)
+                        response_data = await response.json()
+                        if settings.debug:
+                            log_payload("model swap response", response_data)
+                        node.checkpoint = job.checkpoint
+            job.model = node.checkpoint
+            if job.modelprompts: #load the model default positive and negative prompts
+                job.payload.update(self.model_prompts(job.payload, job.model))
+            return await self.generate_image(job.payload, job.user_id, node)
+
+    async def extract_all(self, urls):
+        """Extracts every url at once and returns the descriptions in their original order, dropping any that miss the deadline"""
+        settings = current_settings()
+        if not urls:
+            return []
+        tasks = [asyncio.create_task(self.extract_text_from_url(url)) for url in urls]
+        done, pending = await asyncio.wait(tasks, timeout=settings.extracttimeout)
+        for task in pending:
+            task.cancel() #anything still running past the per message deadline is dropped
+        extracted = []
+        for url, task in zip(urls, tasks):
+            if task not in done:
+                continue
+            if task.exception() is not None:
+                log_event("url fail", level=logging.WARNING, url=url, error=repr(task.exception()))
+                continue
+            if task.result():
+                extracted.append(task.result())
+        if settings.debug:
+            log_event("url cache", level=logging.DEBUG, **self.url_cache.report())
+        return extracted
 
     async def extract_text_from_url(self, url):
         """This function takes a url and returns a description of either the webpage or the picture."""
-        response = requests.head(url, timeout=300)
-        if 'content-type' in response.headers:
-            if 'image' in response.headers.get('content-type'):
-                image_response = requests.get(url, timeout=300)
-                if image_response.status_code == 200:
-                    image = Image.open(io.BytesIO(image_response.content))
-                    if SETTINGS["multimodal"][0] == "True":
-                        image = image.convert('RGB')
-                        jpg_buffer = io.BytesIO()
-                        image.save(jpg_buffer, format='JPEG')
-                        jpg_base64 = base64.b64encode(jpg_buffer.getvalue()).decode('utf-8')
-                        photodescription = f'\n<img src="data:image/jpeg;base64,{jpg_base64}">'
-                        return photodescription
-                    png_payload = {"image": "data:image/png;base64," + base64.b64encode(io.BytesIO(image_response.content).read()).decode('utf-8')}
-                    async with aiohttp.ClientSession() as session: #make the BLIP interrogate API call
-                        async with session.post(f'{SETTINGS["imageapi"][0]}/sdapi/v1/interrogate', json=png_payload) as response:
-                            if response.status == 200:
-                                data = await response.json()
-                                cleaneddescription = data["caption"].split(",")[0].strip()
-                                photodescription = f'The URL is a picture of the following topics: {cleaneddescription}'
-                                return photodescription
-                else: return "There was an error with the link"
-        else:
-            parser = HtmlParser.from_url(url, Tokenizer("english"))
-            stemmer = Stemmer("english")
-            summarizer = Summarizer(stemmer)
-            summarizer.stop_words = get_stop_words("english") #sumy summarizer setup stuff
-            compileddescription = ""
-            for sentence in summarizer(parser.document, 4):
-                compileddescription = f' {compileddescription} {sentence}'
-            sitedescription = f'The URL is a website about the following:{compileddescription}'
-            return sitedescription
-
-    async def moderate_prompt(self, prompt):
+        with self.metrics.span("stage", stage="url", backend="web"):
+            description = await self.url_cache.get_or_compute(f'url:{url}', lambda: self.describe_url(url)) #repeat links are served from the cache
+        return description if description is not None else "There was an error with the link"
+
+    async def describe_url(self, url):
+        """Fetches a url and describes it, returns None on failure so errors are not cached"""
+        settings = current_settings()
+        try:
+            async with self.sessions["web"].get(url) as response:
+                if response.status != 200:
+                    return None
+                if 'image' in response.headers.get('content-type', ''):
+                    image_bytes = await self.read_capped(response, settings.imagemaxbytes)
+                    if image_bytes is None:
+                        return None
+                    digest = hashlib.sha256(image_bytes).hexdigest() #reuploads of the same picture share one cache entry
+                    reducedkey = f'{digest}:{settings.imagemaxdim}:{settings.imagejpegquality}'
+                    if settings.multimodal:
+                        return await self.url_cache.get_or_compute(f'jpeg:{reducedkey}', lambda: self.describe_image_multimodal(image_bytes))
+                    return await self.url_cache.get_or_compute(f'caption:{reducedkey}', lambda: self.describe_image_interrogate(image_bytes))
+                html = await response.text(errors='replace')
+        except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeDecodeError, BackendDown, BackendError): #a link that could not be described is not worth failing the chat over
+            return None
+        with self.metrics.span("stage", stage="summarize", backend="bot"):
+            compileddescription = await asyncio.get_running_loop().run_in_executor(self.extract_pool, summarize_html, html, url) #sumy parsing and LexRank are cpu bound so they run in the pool
+        sitedescription = f'The URL is a website about the following:{compileddescription}'
+        return sitedescription
+
+    async def read_capped(self, response, maxbytes):
+        """Streams a response body, returns None if it is bigger than maxbytes so huge files are never held in memory"""
+        if response.content_length is not None and response.content_length > maxbytes:
+            self.metrics.count("metatron_images_rejected_total", reason="size")
+            return None
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(65536):
+            body.extend(chunk)
+            if len(body) > maxbytes: #content-length can be missing or wrong, so the cap is also checked as it streams in
+                self.metrics.count("metatron_images_rejected_total", reason="size")
+                return None
+        return bytes(body)
+
+    async def reduce_image(self, image_bytes):
+        """Downscales a picture to the configured size and quality, returns base64 jpeg or None if it isnt an image PIL can read"""
+        settings = current_settings()
+        try:
+            with self.metrics.span("stage", stage="reduce", backend="bot"):
+                jpg_bytes = await asyncio.get_running_loop().run_in_executor(self.extract_pool, reduce_image, image_bytes, settings.imagemaxdim, settings.imagejpegquality) #decode and re-encode off the event loop
+        except (OSError, ValueError, Image.DecompressionBombError):
+            self.metrics.count("metatron_images_rejected_total", reason="decode")
+            return None
+        self.metrics.count("metatron_image_bytes_in_total", len(image_bytes))
+        self.metrics.count("metatron_image_bytes_out_total", len(jpg_bytes))
+        self.metrics.count("metatron_image_bytes_saved_total", max(len(image_bytes) - len(jpg_bytes), 0))
+        return base64.b64encode(jpg_bytes).decode('utf-8')
+
+    async def describe_image_multimodal(self, image_bytes):
+        """Inlines a downscaled picture as a jpeg for llava"""
+        jpg_base64 = await self.reduce_image(image_bytes)
+        if jpg_base64 is None:
+            return None
+        photodescription = f'\n<img src="data:image/jpeg;base64,{jpg_base64}">'
+        return photodescription
+
+    async def describe_image_interrogate(self, image_bytes):
+        """Captions a downscaled picture with the A1111 BLIP interrogator"""
+        jpg_base64 = await self.reduce_image(image_bytes)
+        if jpg_base64 is None:
+            return None
+        jpg_payload = {"image": "data:image/jpeg;base64," + jpg_base64}
+        async with self.gates["image"].slot("interrogate"): #interrogates share the image backend, they are queued as their own user so they take turns with gens
+            with self.metrics.span("stage", stage="interrogate", backend="image"):
+                async with self.pools["image"].lease() as node, self.sessions["image"].post(f'{node.url}/sdapi/v1/interrogate', json=jpg_payload) as response: #make the BLIP interrogate API call on the least busy node
+                    if response.status != 200:
+                        raise BackendError("image", response.status)
+                    data = await response.json()
+        cleaneddescription = data["caption"].split(",")[0].strip()
+        photodescription = f'The URL is a picture of the following topics: {cleaneddescription}'
+        return photodescription
+
+    async def moderate_prompt(self, prompt, settings=None):
         """Checks prompts for disallowed things from the global default negatives"""
-        negative_values = [neg.strip() for neg in self.defaultimage_payload["negative_prompt"].split(",")] # Split negative values into a list
-        for neg in negative_values:
-            prompt = re.sub(r'\b' + re.escape(neg) + r'\b', '', prompt)
-        return prompt
+        settings = settings or current_settings()
+        key = (settings.negativeterms, settings.moderationignorecase, settings.moderationwholeword)
+        if self.moderator is None or self.moderator.key != key: #only recompile when the blocklist or its options change
+            self.moderator = PromptModerator(*key)
+            log_event("moderation", message=f"compiled {self.moderator.terms} blocked terms")
+        return self.moderator.moderate(prompt)
 
 discintents = discord.Intents.all() #discord intents
 client = MyClient(intents=discintents) #client intents
 
-class Wordgenbuttons(discord.ui.View):
+class Wordgenbuttons(SettingsSnapshot, discord.ui.View):
     """Class for the ui buttons on speakgen"""
 
     def __init__(self, request, user_id, prompt, *args, **kwargs):
@@ -261,54 +2474,74 @@ class Wordgenbuttons(discord.ui.View):
     async def reroll(self, interaction: discord.Interaction, button: discord.ui.Button):
         """Rerolls last reply"""
         if self.userid == interaction.user.id:
-            if len(global_interaction_history[self.userid]) > 0:
-                global_interaction_history[self.userid].pop(len(global_interaction_history[self.userid]) - 1)
             await interaction.response.defer() #this makes it not say "interaction failed" when things take a long time
-            processedreply = await client.generate_word(self.request, interaction.user.id, self.prompt)
-            await interaction.followup.send(f"{interaction.user.mention} {processedreply}", view=Wordgenbuttons(self.request, interaction.user.id, self.prompt)) #send message to channel
-            await interaction.delete_original_response()
-            logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("wordgen", "cyan")}  | {colored(interaction.user.name, "yellow")}:{colored(interaction.user.id, "light_yellow")} | {colored(interaction.guild, "red")}:{colored(interaction.channel, "light_red")} | P={colored(self.prompt, "light_magenta")}')
+            posted = False
+            with client.track(interaction.message.id, "reroll"): #pressing again or deleting the message stops this reroll
+                async with client.backend_guard(interaction.followup.send, "word"), client.chat_sessions.hold(self.userid): #the pop and the new reply happen with none of this users other chats in between
+                    history = await client.history.get(self.userid)
+                    lastentry = history[-1] if history else None
+                    await client.history.pop(self.userid)
+                    history = await client.history.get(self.userid)
+                    beforeentry = history[-1] if history else None
+                    try:
+                        await client.send_word(self.request.again(), interaction.user.id, self.prompt, interaction.followup.send, interaction.user.mention, notify=queue_notifier(interaction.followup.send, "chat", ephemeral=True)) #send message to channel
+                        posted = True
+                    finally:
+                        history = await client.history.get(self.userid)
+                        if lastentry is not None and (history[-1] if history else None) is beforeentry: #no new reply made it into the history, so the old one stays
+                            await client.history.append(self.userid, lastentry)
+            if posted: #a failed reroll keeps the message it was meant to replace
+                await interaction.delete_original_response()
+                log_event("wordgen", interaction.user, interaction.guild, interaction.channel, prompt=self.prompt)
 
     @discord.ui.button(label='Delete last reply', emoji="❌", style=discord.ButtonStyle.grey)
     async def delete_message(self, interaction: discord.Interaction, button: discord.ui.Button):
         """Deletes message"""
         if self.userid == interaction.user.id:
-            global_interaction_history[self.userid].pop(len(global_interaction_history[self.userid]) - 1)
+            client.cancel_work(interaction.message.id)
+            async with client.chat_sessions.hold(self.userid):
+                await client.history.pop(self.userid)
             await interaction.message.delete()
-            logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("delete", "cyan")}   | {colored(interaction.user.name, "yellow")}:{colored(interaction.user.id, "light_yellow")} | {colored(interaction.guild, "red")}:{colored(interaction.channel, "light_red")} | {colored(interaction.id, "light_magenta")}')
+            log_event("delete", interaction.user, interaction.guild, interaction.channel, id=interaction.id)
 
     @discord.ui.button(label='Show History', emoji="📜", style=discord.ButtonStyle.grey)
     async def dmimage(self, interaction: discord.Interaction, button: discord.ui.Button):
         """Prints history to user"""
         if self.userid == interaction.user.id:
             await interaction.response.defer() #ensure we dont get the interaction failed message if it takes too long to respond
-            history = io.BytesIO(json.dumps(global_interaction_history[self.userid], indent=1).encode())
+            history = io.BytesIO(json.dumps(await client.history.get(self.userid), indent=1).encode())
             await interaction.followup.send('**HISTORY:**', ephemeral=True, file=discord.File(history, filename='history.txt'))
-            logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("history", "cyan")}  | {colored(interaction.user.name, "yellow")}:{colored(interaction.user.id, "light_yellow")} | {colored(interaction.guild, "red")}:{colored(interaction.channel, "light_red")}')
+            log_event("history", interaction.user, interaction.guild, interaction.channel)
 
     @discord.ui.button(label='Continue', emoji="➕", style=discord.ButtonStyle.grey)
     async def llmcontinue(self, interaction: discord.Interaction, button: discord.ui.Button):
         """Continues last reply"""
         if self.userid == interaction.user.id:
             await interaction.response.defer() #this makes it not say "interaction failed" when things take a long time
-            self.request['_continue'] = True
-            prevresponse = global_interaction_history[self.userid][-1][1]
-            processedreply = await client.generate_word(self.request, interaction.user.id, self.prompt)
-            global_interaction_history[self.userid].pop(len(global_interaction_history[self.userid]) - 2)
-            del self.request['_continue']
-            await interaction.followup.send(f"{interaction.user.mention} {processedreply.replace(prevresponse, '')}", view=Wordgenbuttons(self.request, interaction.user.id, self.prompt)) #send message to channel
-            logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("wordgen", "cyan")}  | {colored(interaction.user.name, "yellow")}:{colored(interaction.user.id, "light_yellow")} | {colored(interaction.guild, "red")}:{colored(interaction.channel, "light_red")} | P={colored(self.prompt, "light_magenta")}')
+            with client.track(interaction.message.id, "continue"): #pressing again or deleting the message stops this continue
+                async with client.backend_guard(interaction.followup.send, "word"), client.chat_sessions.hold(self.userid): #the continued reply replaces the last one with none of this users other chats in between
+                    history = await client.history.get(self.userid)
+                    prevresponse = history[-1][1] if history else ''
+                    lastentry = history[-1] if history else None
+                    try:
+                        await client.send_word(self.request.again(continuing=True), interaction.user.id, self.prompt, interaction.followup.send, interaction.user.mention, prevresponse, queue_notifier(interaction.followup.send, "chat", ephemeral=True)) #send message to channel
+                    finally:
+                        history = await client.history.get(self.userid)
+                        if history and history[-1] is not lastentry: #the continued reply made it into the history, even if posting it was cancelled, so it replaces the one it continues
+                            await client.history.pop(self.userid, -2)
+            log_event("wordgen", interaction.user, interaction.guild, interaction.channel, prompt=self.prompt)
 
     @discord.ui.button(label='Wipe History', emoji="🤯", style=discord.ButtonStyle.grey)
     async def delete_history(self, interaction: discord.Interaction, button: discord.ui.Button):
         """Deletes history"""
         if self.userid == interaction.user.id:
-            global_interaction_history[self.userid] = []
+            async with client.chat_sessions.hold(self.userid):
+                await client.history.wipe(self.userid)
             await interaction.response.send_message("History wiped", ephemeral=True)
-            logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("forget", "cyan")}   | {colored(interaction.user.name, "yellow")}:{colored(interaction.user.id, "light_yellow")} | {colored(interaction.guild, "red")}:{colored(interaction.channel, "light_red")} | {colored(interaction.id, "light_magenta")}')
+            log_event("forget", interaction.user, interaction.guild, interaction.channel, id=interaction.id)
 
 
-class Speakgenbuttons(discord.ui.View):
+class Speakgenbuttons(SettingsSnapshot, discord.ui.View):
     """Class for the ui buttons on speakgen"""
 
     def __init__(self, params, user_id, userprompt, *args, **kwargs):
@@ -322,87 +2555,90 @@ class Speakgenbuttons(discord.ui.View):
     async def reroll(self, interaction: discord.Interaction, button: discord.ui.Button):
         """Rerolls sound"""
         await interaction.response.defer() #this makes it not say "interaction failed" when things take a long time
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f'{SETTINGS["speakapi"][0]}/txt2wav', params=self.params) as response:
-                response_data = await response.read()
-                if response_data:
-                    wav_bytes_io = io.BytesIO(response_data)
+        with client.track(interaction.message.id, "reroll"): #pressing again or deleting the message stops this reroll
+            async with client.backend_guard(interaction.followup.send, "speak"):
+                speech, extension = await client.generate_speech(self.params, interaction.user.id, queue_notifier(interaction.followup.send, "speak", ephemeral=True))
+                if speech is not None:
                     truncatedfilename = self.userprompt[:1000]
-                    await interaction.followup.send(file=discord.File(wav_bytes_io, filename=f"{truncatedfilename}.wav"), view=Speakgenbuttons(self.params, interaction.user.id, self.userprompt))
-                    logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("speakgen", "cyan")} | {colored(interaction.user.name, "yellow")}:{colored(interaction.user.id, "light_yellow")} | {colored(interaction.guild, "red")}:{colored(interaction.channel, "light_red")} | P={colored(self.userprompt, "light_magenta")}')
+                    await client.send_media(interaction.followup.send, discord.File(speech, filename=f"{truncatedfilename}.{extension}"), self.params, view=Speakgenbuttons(self.params, interaction.user.id, self.userprompt))
+                    log_event("speakgen", interaction.user, interaction.guild, interaction.channel, prompt=self.userprompt)
 
     @discord.ui.button(label='Mail', emoji="✉", style=discord.ButtonStyle.grey)
     async def dmimage(self, interaction: discord.Interaction, button: discord.ui.Button):
         """DMs sound"""
         await interaction.response.defer() #ensure we dont get the interaction failed message if it takes too long to respond
-        async with aiohttp.ClientSession() as session:
-            async with session.get(interaction.message.attachments[0].url) as response:
-                if response.status == 200:
-                    sound_bytes = await response.read()
-                    dm_channel = await interaction.user.create_dm()
-                    truncatedfilename = self.userprompt[:1000]
-                    await dm_channel.send(file=discord.File(io.BytesIO(sound_bytes), filename=f'{truncatedfilename}.wav'))
-                    logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("dm speak", "cyan")} | {colored(interaction.user.name, "yellow")}:{colored(interaction.user.id, "light_yellow")} | {colored(interaction.guild, "red")}:{colored(interaction.channel, "light_red")} | {colored(interaction.message.attachments[0].url, "light_magenta")}')
-                else: await interaction.response.send_message("Failed to fetch the speak.")
+        sound_bytes, filename = await client.fetch_media(interaction.message) #served from the media cache, the CDN is only a fallback
+        if sound_bytes is not None:
+            dm_channel = await interaction.user.create_dm()
+            await dm_channel.send(file=discord.File(io.BytesIO(sound_bytes), filename=filename))
+            log_event("dm speak", interaction.user, interaction.guild, interaction.channel, id=interaction.message.id)
+        else: await interaction.followup.send("Failed to fetch the speak.")
 
     @discord.ui.button(label='Delete', emoji="❌", style=discord.ButtonStyle.grey)
     async def delete_message(self, interaction: discord.Interaction, button: discord.ui.Button):
         """Deletes message"""
         if self.userid == interaction.user.id:
+            client.cancel_work(interaction.message.id)
             await interaction.message.delete()
-            logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("delete", "cyan")}   | {colored(interaction.user.name, "yellow")}:{colored(interaction.user.id, "light_yellow")} | {colored(interaction.guild, "red")}:{colored(interaction.channel, "light_red")} | {colored(interaction.id, "light_magenta")}')
+            await client.media_cache.discard(interaction.message.id)
+            log_event("delete", interaction.user, interaction.guild, interaction.channel, id=interaction.id)
 
-class Imagegenbuttons(discord.ui.View):
+class Imagegenbuttons(SettingsSnapshot, discord.ui.View):
     """class for the ui buttons on the image gens"""
 
-    def __init__(self, payload, user_id, *args, **kwargs):
+    def __init__(self, payload, user_id, model=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.payload = payload
         self.userid = user_id
+        self.model = model
         self.timeout = None
 
     @discord.ui.button(label='Edit', emoji="✏️", style=discord.ButtonStyle.grey)
     async def edit(self, interaction: discord.Interaction, button: discord.ui.Button):
         """Edit prompt and gen new image"""
-        await interaction.response.send_modal(Editpromptmodal(self.payload)) #calls the edit modal
+        await interaction.response.send_modal(Editpromptmodal(self.payload, self.model)) #calls the edit modal
 
     @discord.ui.button(label='Reroll', emoji="🎲", style=discord.ButtonStyle.grey)
     async def reroll(self, interaction: discord.Interaction, button: discord.ui.Button):
         """Rerolls image using same prompt"""
         await interaction.response.defer() #this makes it not say "interaction failed" when things take a long time
-        composite_image_bytes = await client.generate_image(self.payload, interaction.user.id) #generate image and place it into composite_image_bytes
-        if composite_image_bytes is not None:
-            await interaction.followup.send(content="Reroll", file=discord.File(composite_image_bytes, filename='composite_image.png'), view=Imagegenbuttons(self.payload, interaction.user.id))
-            logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("reroll", "cyan")}   | {colored(interaction.user.name, "yellow")}:{colored(interaction.user.id, "light_yellow")} | {colored(interaction.guild, "red")}:{colored(interaction.channel, "light_red")} | P={colored(self.payload["prompt"], "light_magenta")}')
-        else:
-            await interaction.followup.send(content="Image generation failed.")  # Handle the case when composite_image_bytes is None
+        with client.track(interaction.message.id, "reroll"): #pressing again or deleting the message stops this reroll, on A1111 too
+            async with client.backend_guard(interaction.followup.send, "image"):
+                job = await client.queue_image(self.payload, interaction.user.id, self.model, modelprompts=False, notify=queue_notifier(interaction.followup.send, "image", ephemeral=True)) #the payload already carries the model prompts
+                composite_image = job.future.result() #generate image and place it into composite_image
+                if composite_image is not None:
+                    await client.send_media(interaction.followup.send, composite_image, self.payload, content="Reroll", view=Imagegenbuttons(self.payload, interaction.user.id, job.model))
+                    log_event("reroll", interaction.user, interaction.guild, interaction.channel, prompt=self.payload["prompt"])
+                else:
+                    await interaction.followup.send(content="Image generation failed.")  # Handle the case when composite_image is None
 
     @discord.ui.button(label='Mail', emoji="✉", style=discord.ButtonStyle.grey)
     async def dmimage(self, interaction: discord.Interaction, button: discord.ui.Button):
         """DMs Image to user"""
         await interaction.response.defer() #ensure we dont get the interaction failed message if it takes too long to respond
-        async with aiohttp.ClientSession() as session:
-            async with session.get(interaction.message.attachments[0].url) as response:
-                if response.status == 200:
-                    image_bytes = await response.read()
-                    dm_channel = await interaction.user.create_dm()
-                    await dm_channel.send(file=discord.File(io.BytesIO(image_bytes), filename='composite_image.png'))
-                    logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("dm image", "cyan")} | {colored(interaction.user.name, "yellow")}:{colored(interaction.user.id, "light_yellow")} | {colored(interaction.guild, "red")}:{colored(interaction.channel, "light_red")} | {colored(interaction.message.attachments[0].url, "light_magenta")}')
-                else: await interaction.response.send_message("Failed to fetch the image.")
+        image_bytes, filename = await client.fetch_media(interaction.message) #served from the media cache, the CDN is only a fallback
+        if image_bytes is not None:
+            dm_channel = await interaction.user.create_dm()
+            await dm_channel.send(file=discord.File(io.BytesIO(image_bytes), filename=filename))
+            log_event("dm image", interaction.user, interaction.guild, interaction.channel, id=interaction.message.id)
+        else: await interaction.followup.send("Failed to fetch the image.")
 
     @discord.ui.button(label='Delete', emoji="❌", style=discord.ButtonStyle.grey)
     async def delete_message(self, interaction: discord.Interaction, button: discord.ui.Button):
         """Deletes message"""
         if self.userid == interaction.user.id:
+            client.cancel_work(interaction.message.id)
             await interaction.message.delete()
-            logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("delete", "cyan")}   | {colored(interaction.user.name, "yellow")}:{colored(interaction.user.id, "light_yellow")} | {colored(interaction.guild, "red")}:{colored(interaction.channel, "light_red")} | {colored(interaction.id, "light_magenta")}')
+            await client.media_cache.discard(interaction.message.id)
+            log_event("delete", interaction.user, interaction.guild, interaction.channel, id=interaction.id)
 
-class Editpromptmodal(discord.ui.Modal, title='Edit Prompt'):
+class Editpromptmodal(SettingsSnapshot, discord.ui.Modal, title='Edit Prompt'):
     """prompt editing modal."""
 
-    def __init__(self, payload, *args, **kwargs):
+    def __init__(self, payload, model=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.payload = payload
+        self.model = model
         self.timeout = None
         self.add_item(discord.ui.TextInput(label="Prompt", default=self.payload["prompt"], required=True, style=discord.TextStyle.long))
 
@@ -411,12 +2647,15 @@ class Editpromptmodal(discord.ui.Modal, title='Edit Prompt'):
         newprompt = str(self.children[0])
         moderatedprompt = await client.moderate_prompt(newprompt)
         self.payload["prompt"] = moderatedprompt.strip()
-        composite_image_bytes = await client.generate_image(self.payload, interaction.user.id) #make the api call to generate the new image
-        if composite_image_bytes is not None:
-            truncatedprompt = moderatedprompt[:1500]
-            await interaction.followup.send(content=f'Edit: New prompt `{truncatedprompt}`', file=discord.File(composite_image_bytes, filename='composite_image.png'), view=Imagegenbuttons(self.payload, interaction.user.id))
-            logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("edit", "cyan")}     | {colored(interaction.user.name, "yellow")}:{colored(interaction.user.id, "light_yellow")} | {colored(interaction.guild, "red")}:{colored(interaction.channel, "light_red")} | P={colored(self.payload["prompt"], "light_magenta")}')
-        else: await interaction.followup.send(content="Image generation failed.")  # Handle the case when composite_image_bytes is None
+        with client.track(interaction.message.id if interaction.message else None, "edit"): #submitting again or deleting the message stops the edit, on A1111 too
+            async with client.backend_guard(interaction.followup.send, "image"):
+                job = await client.queue_image(self.payload, interaction.user.id, self.model, modelprompts=False, notify=queue_notifier(interaction.followup.send, "image", ephemeral=True))
+                composite_image = job.future.result() #make the api call to generate the new image
+                if composite_image is not None:
+                    truncatedprompt = moderatedprompt[:1500]
+                    await client.send_media(interaction.followup.send, composite_image, self.payload, content=f'Edit: New prompt `{truncatedprompt}`', view=Imagegenbuttons(self.payload, interaction.user.id, job.model))
+                    log_event("edit", interaction.user, interaction.guild, interaction.channel, prompt=self.payload["prompt"])
+                else: await interaction.followup.send(content="Image generation failed.")  # Handle the case when composite_image is None
 
 @client.tree.command() #Begins imagen slash command stuff
 @app_commands.describe(usermodel="Choose the model", userprompt="Describe what you want to gen", userbatch="Batch Size", usernegative="Enter things you dont want in the gen", userseed="Seed", usersteps="Number of steps", userlora="Pick a LORA", userwidth="Image width", userheight="Image height")
@@ -424,109 +2663,82 @@ class Editpromptmodal(discord.ui.Modal, title='Edit Prompt'):
 @app_commands.choices(userlora=client.loras)
 async def imagegen(interaction: discord.Interaction, userprompt: str, usernegative: Optional[str] = None, usermodel: Optional[app_commands.Choice[str]] = None, userlora: Optional[app_commands.Choice[str]] = None, userbatch: Optional[int] = None, userseed: Optional[int] = None, usersteps: Optional[int] = None, userheight: Optional[int] = None, userwidth: Optional[int] = None):
     """Slash command that generates images"""
-    if SETTINGS["enableimage"][0] != "True":
+    settings = current_settings() #the tree snapshotted the settings for this command
+    if not settings.enableimage:
         await interaction.response.send_message("Image generation is currently disabled.")
         return
-    banned_users = SETTINGS["bannedusers"][0].split(',')
-    if str(interaction.user.id) in banned_users:
+    if interaction.user.id in settings.bannedusers:
         return  # Exit the function if the author is banned
     await interaction.response.defer() #respond so discord doesnt get mad it takes a long time to actually respond to the message
-    payload = client.defaultimage_payload.copy() #set up default payload
-    ignore_fields = [field.strip() for field in SETTINGS["ignorefields"][0].split(",")]  # Split ignored fields into a list
-    moderatedprompt = await client.moderate_prompt(userprompt)
-    payload["prompt"] = moderatedprompt.strip() #put the prompt into the payload
-    if usernegative is not None:
-        if "usernegative" not in ignore_fields:
-            payload["negative_prompt"] = f"{usernegative},{payload['negative_prompt']}"
-        else: usernegative = None #These checks allow us to ignore fields if we wish.
-    if userbatch is not None:
-        if "userbatch" not in ignore_fields:
-            if userbatch <= int(SETTINGS["maxbatch"][0]):
-                payload["batch_size"] = userbatch
-        else: userbatch = None
-    if userseed is not None:
-        if "userseed" not in ignore_fields:
-            payload["seed"] = userseed
-        else: userseed = None
-    if usersteps is not None:
-        if "usersteps" not in ignore_fields:
-            payload["steps"] = usersteps
-        else: usersteps = None
-    if userwidth is not None:
-        if "userwidth" not in ignore_fields:
-            if userwidth <= int(SETTINGS["maxwidth"][0]):
-                payload["width"] = userwidth
-    if userheight is not None:
-        if "userheight" not in ignore_fields:
-            if userheight <= int(SETTINGS["maxheight"][0]):
-                payload["height"] = userheight
-    if userlora is not None:
-        if "userlora" not in ignore_fields:
-            matches = re.findall(r"value='(.*?)'", str(userlora))
-            currentlora = matches[0]
-            payload["prompt"] = f"<lora:{matches[0]}:1>,{payload['prompt']}"
-        else: userlora = None
-    else: currentlora = None
-    if usermodel is not None: #Check the user models choice if present
-        if "usermodel" not in ignore_fields:
-            matches = re.findall(r"value='(.*?)'", str(usermodel))
-            model_payload = {"sd_model_checkpoint": matches[0]} #put model choice into payload
-            async with aiohttp.ClientSession() as session: #make the api request to change to the requested model
-                async with session.post(f'{SETTINGS["imageapi"][0]}/sdapi/v1/options', json=model_payload) as response:
-                    response_data = await response.json()
-                    if SETTINGS["debug"][0] == 'True':
-                        logging.debug(f'USERMODEL DEBUG RESPONSE: {colored(json.dumps(response_data, indent=1), "light_blue")}')
-        else: usermodel = None
-    else:
-        model_payload = None
-        for default_model in SETTINGS["defaultmodel"]: #This loads the server specific default model if it exists
-            checkid, defaultmodelname, defaultmodelprompt, defaultmodelneg = default_model.strip().split("|", 3)  #grab the second and third values and put them into variables
-            if str(interaction.channel.id) == checkid:
-                model_payload = {"sd_model_checkpoint": defaultmodelname}
-                payload["prompt"] = f"{defaultmodelprompt},{payload['prompt']}"
-                payload["negative_prompt"] = f"{defaultmodelneg},{payload['negative_prompt']}"
-                break
-            elif str(interaction.guild_id) == checkid:
-                model_payload = {"sd_model_checkpoint": defaultmodelname}
+    with client.metrics.span("command", command="imagegen"):
+        payload = settings.imagesettings.copy() #set up default payload
+        ignore_fields = settings.ignorefields
+        moderatedprompt = await client.moderate_prompt(userprompt, settings)
+        payload["prompt"] = moderatedprompt.strip() #put the prompt into the payload
+        if usernegative is not None:
+            if "usernegative" not in ignore_fields:
+                payload["negative_prompt"] = f"{usernegative},{payload['negative_prompt']}"
+            else: usernegative = None #These checks allow us to ignore fields if we wish.
+        if userbatch is not None:
+            if "userbatch" not in ignore_fields:
+                if userbatch <= settings.maxbatch:
+                    payload["batch_size"] = userbatch
+            else: userbatch = None
+        if userseed is not None:
+            if "userseed" not in ignore_fields:
+                payload["seed"] = userseed
+            else: userseed = None
+        if usersteps is not None:
+            if "usersteps" not in ignore_fields:
+                payload["steps"] = usersteps
+            else: usersteps = None
+        if userwidth is not None:
+            if "userwidth" not in ignore_fields:
+                if userwidth <= settings.maxwidth:
+                    payload["width"] = userwidth
+        if userheight is not None:
+            if "userheight" not in ignore_fields:
+                if userheight <= settings.maxheight:
+                    payload["height"] = userheight
+        if userlora is not None:
+            if "userlora" not in ignore_fields:
+                matches = re.findall(r"value='(.*?)'", str(userlora))
+                currentlora = matches[0]
+                payload["prompt"] = f"<lora:{matches[0]}:1>,{payload['prompt']}"
+            else: userlora = None
+        else: currentlora = None
+        checkpoint = None
+        if usermodel is not None: #Check the user models choice if present
+            if "usermodel" not in ignore_fields:
+                matches = re.findall(r"value='(.*?)'", str(usermodel))
+                checkpoint = matches[0] #the scheduler swaps to this model when the job runs
+            else: usermodel = None
+        else:
+            default_model = settings.defaultmodels.get(interaction.channel.id) or settings.defaultmodels.get(interaction.guild_id) #This loads the channel or server specific default model if it exists, channel first
+            if default_model:
+                checkpoint, defaultmodelprompt, defaultmodelneg = default_model
                 payload["prompt"] = f"{defaultmodelprompt},{payload['prompt']}"
                 payload["negative_prompt"] = f"{defaultmodelneg},{payload['negative_prompt']}"
-        if model_payload:
-            async with aiohttp.ClientSession() as session: #make the api request to change to the requested model
-                async with session.post(f'{SETTINGS["imageapi"][0]}/sdapi/v1/options', json=model_payload) as response:
-                    response_data = await response.json()
-                    if SETTINGS["debug"][0] == 'True':
-                        logging.debug(f'DEFAULTMODEL DEBUG RESPONSE: {colored(json.dumps(response_data, indent=1), "light_blue")}')
-    async with aiohttp.ClientSession() as session: #Check what the currently loaded model is, and then load the appropriate default prompt and negatives.
-        async with session.get(f'{SETTINGS["imageapi"][0]}/sdapi/v1/options', json=payload) as response: #Api request to get the current model.
-            response_data = await response.json()
-            currentmodel = response_data.get("sd_model_checkpoint", "")  # Extract current model checkpoint value
-            modelprompt = ""
-            modelnegative = ""
-            for modelline in SETTINGS["models"]:
-                model, modeltemp, modelnegtemp = modelline.strip().split("|", 2)  #grab the second and third values and put them into variables
-                if model == currentmodel: #find the matching model and load the model default positive and negative prompts
-                    modelprompt = modeltemp
-                    modelnegative = modelnegtemp
-            if modelprompt:
-                payload["prompt"] = f"{modelprompt},{payload['prompt']}" #Combine the model defaults with the user choices and update payload
-            if modelnegative:
-                payload["negative_prompt"] = f"{modelnegative},{payload['negative_prompt']}"
-    composite_image_bytes = await client.generate_image(payload, interaction.user.id) #generate image and place it into composite_image_bytes
-    if composite_image_bytes is not None:
-        truncatedprompt = moderatedprompt[:1500]
-        await interaction.followup.send(content=f"Prompt: **`{truncatedprompt}`**, Negatives: `{usernegative}` Model: `{currentmodel}` Lora: `{currentlora}` Seed `{userseed}` Batch Size `{userbatch}` Steps `{usersteps}`", file=discord.File(composite_image_bytes, filename='composite_image.png'), view=Imagegenbuttons(payload, interaction.user.id)) #Send message to discord with the image and request parameters
-    else: await interaction.followup.send("API failed")
-    logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("imagegen", "cyan")} | {colored(interaction.user.name, "yellow")}:{colored(interaction.user.id, "light_yellow")} | {colored(interaction.guild, "red")}:{colored(interaction.channel, "light_red")} | P={colored(payload["prompt"], "light_magenta")}, N={colored(usernegative, "light_magenta")}, M={colored(currentmodel, "light_magenta")} L={colored(currentlora, "light_magenta")}')
+        async with client.backend_guard(interaction.followup.send, "image"):
+            job = await client.queue_image(payload, interaction.user.id, checkpoint, modelprompts=True, notify=queue_notifier(interaction.followup.send, "image", ephemeral=True)) #wait for the scheduler to run the job
+            composite_image = job.future.result()
+            currentmodel = job.model
+            if composite_image is not None:
+                truncatedprompt = moderatedprompt[:1500]
+                await client.send_media(interaction.followup.send, composite_image, payload, content=f"Prompt: **`{truncatedprompt}`**, Negatives: `{usernegative}` Model: `{currentmodel}` Lora: `{currentlora}` Seed `{userseed}` Batch Size `{userbatch}` Steps `{usersteps}`", view=Imagegenbuttons(payload, interaction.user.id, currentmodel)) #Send message to discord with the image and request parameters
+            else: await interaction.followup.send("API failed")
+            log_event("imagegen", interaction.user, interaction.guild, interaction.channel, prompt=payload["prompt"], negative=usernegative, model=currentmodel, lora=currentlora)
 
 @client.tree.command()
 @app_commands.choices(uservoice=client.voices)
 async def speakgen(interaction: discord.Interaction, userprompt: str, uservoice: Optional[app_commands.Choice[str]] = None):
     """Slash Command that generates speech"""
-    if SETTINGS["enablespeak"][0] != "True":
+    settings = current_settings()
+    if not settings.enablespeak:
         await interaction.response.send_message("Voice generation is currently disabled.")
         return
     await interaction.response.defer()
-    async with aiohttp.ClientSession() as session:
+    with client.metrics.span("command", command="speakgen"):
         if uservoice is not None:
             matches = re.findall(r"value='(.*?)'", str(uservoice))
             currentvoice = matches[0]
@@ -535,36 +2747,49 @@ async def speakgen(interaction: discord.Interaction, userprompt: str, uservoice:
             else:
                 params = {'inputstring': userprompt, 'voicefile': currentvoice}
         else:
-            for default_voice in SETTINGS["defaultvoice"]: #This loads the server specific default model if it exists
-                checkid, defaultvoicename = default_voice.strip().split("|", 1)  #grab the values and put them into variables
-                if str(interaction.channel.id) == checkid:
-                    params = {'inputstring': userprompt, 'voicefile': defaultvoicename}
-                elif str(interaction.guild_id) == checkid:
-                    params = {'inputstring': userprompt, 'voicefile': defaultvoicename}
-                else: params = {'inputstring': userprompt}
-        async with session.get(f'{SETTINGS["speakapi"][0]}/txt2wav', params=params) as response:
-            response_data = await response.read()
-            if response_data:
-                wav_bytes_io = io.BytesIO(response_data)
+            defaultvoicename = settings.defaultvoices.get(interaction.channel.id) or settings.defaultvoices.get(interaction.guild_id) #This loads the channel or server specific default voice if it exists
+            if defaultvoicename:
+                params = {'inputstring': userprompt, 'voicefile': defaultvoicename}
+            else: params = {'inputstring': userprompt}
+        async with client.backend_guard(interaction.followup.send, "speak"):
+            speech, extension = await client.generate_speech(params, interaction.user.id, queue_notifier(interaction.followup.send, "speak", ephemeral=True))
+            if speech is not None:
                 truncatedprompt = userprompt[:1000]
-                await interaction.followup.send(file=discord.File(wav_bytes_io, filename=f"{truncatedprompt}.wav"), view=Speakgenbuttons(params, interaction.user.id, userprompt))
-                logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("speakgen", "cyan")} | {colored(interaction.user.name, "yellow")}:{colored(interaction.user.id, "light_yellow")} | {colored(interaction.guild, "red")}:{colored(interaction.channel, "light_red")} | P={colored(userprompt, "light_magenta")}')
+                await client.send_media(interaction.followup.send, discord.File(speech, filename=f"{truncatedprompt}.{extension}"), params, view=Speakgenbuttons(params, interaction.user.id, userprompt))
+                log_event("speakgen", interaction.user, interaction.guild, interaction.channel, prompt=userprompt)
+
+@client.tree.command()
+async def imagesearch(interaction: discord.Interaction, userquery: str):
+    """Slash command that searches your saved gens by prompt"""
+    settings = current_settings()
+    if not settings.saveimages or client.archive is None:
+        await interaction.response.send_message("Image saving is currently disabled.", ephemeral=True)
+        return
+    if interaction.user.id in settings.bannedusers:
+        return  # Exit the function if the author is banned
+    await interaction.response.defer(ephemeral=True)
+    results = await client.archive.search(userquery, interaction.user.id, 5)
+    if not results:
+        await interaction.followup.send("No saved gens match that.", ephemeral=True)
+        return
+    lines = [f'{datetime.fromtimestamp(created).strftime("%Y-%m-%d %H:%M")} Prompt: `{prompt[:300]}` Model: `{model}` Seed `{seed}`' for prompt, seed, model, created in results]
+    await interaction.followup.send("\n".join(lines), ephemeral=True) #the same prompt, model and seed through /imagegen is served from the archive
+    log_event("imagesearch", interaction.user, interaction.guild, interaction.channel, prompt=userquery)
 
 @client.tree.command()
 async def impersonate(interaction: discord.Interaction, userprompt: str, llmprompt: str):
     """Slash command that allows for one shot prompting"""
-    if SETTINGS["enableword"][0] != "True":  #check if LLM generation is enabled
+    settings = current_settings()
+    if not settings.enableword:  #check if LLM generation is enabled
         await interaction.channel.send("LLM generation is currently disabled.")
         return
-    if str(interaction.user.id) in SETTINGS.get("bannedusers", [""])[0].split(','):
+    if interaction.user.id in settings.bannedusers:
         return  # Exit the function if the author is banned
-    if not global_interaction_history[interaction.user.id]:
-        global_interaction_history[interaction.user.id] = [] #Creates a blank interaction history if it doesnt already exist.
     new_entry = [userprompt, llmprompt] #prepare entry to be placed into the users history
-    global_interaction_history[interaction.user.id].append(new_entry) #update user history
-    if len(global_interaction_history[interaction.user.id]) > 10:
-        global_interaction_history[interaction.user.id].pop(0) #remove oldest result in history once maximum is reached
+    async with client.chat_sessions.hold(interaction.user.id):
+        await client.history.append(interaction.user.id, new_entry) #update user history
     await interaction.response.send_message(f'History inserted:\n User: {userprompt}\n LLM: {llmprompt}')
-    logging.info(f'{colored(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "dark_grey")} | {colored("imperson", "cyan")} | {colored(interaction.user.name, "yellow")}:{colored(interaction.user.id, "light_yellow")} | {colored(interaction.guild, "red")}:{colored(interaction.channel, "light_red")} | P={colored(userprompt, "light_magenta")},{colored(llmprompt, "light_magenta")}')
+    log_event("imperson", interaction.user, interaction.guild, interaction.channel, prompt=userprompt, llmprompt=llmprompt)
 
-client.run(SETTINGS["token"][0], log_handler=None) #run bot
+if __name__ == "__main__": #the image process pool re-imports this file on spawn and forkserver platforms, so only the main process runs the bot, and importing opens nothing it could clobber
+    client.run(SETTINGS.token, log_handler=None) #run bot